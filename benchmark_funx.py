@@ -0,0 +1,180 @@
+"""Benchmarks of the funx_10 generators over sequence lengths.
+
+Times each function at lengths from 32 to about 10^5 trials, measures its
+peak memory, counts its retries and repair swaps (see funx_stats.py) and
+saves everything as JSON. The results are compared with a baseline, by
+default benchmark_baseline.json next to this file: the functions that got
+slower than it are listed and the script exits with 1. Timings depend on
+the machine, so the baseline is not shipped: create it on yours before
+changing the code, e.g.
+
+    $ python benchmark_funx.py --update-baseline
+    (change funx_10.py)
+    $ python benchmark_funx.py --out after.json
+
+Any earlier JSON of results can be given as baseline too (--baseline).
+
+The lengths are rounded down to the nearest length each function accepts
+(e.g. a multiple of 6 for balanceNMinus2_str).
+
+This file can also be imported as a module and contains the following
+functions:
+
+    * run_benchmarks
+    * compare
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tracemalloc
+import numpy as np
+import pandas as pd
+import funx_10
+from funx_stats import collect_stats, summarize
+
+SIZES = [32, 96, 384, 1536, 6144, 24576, 98304]
+# the results compared with by default, written by --update-baseline
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+N_STIM = 8
+
+
+def _stim_df(trials):
+    """a block with each stimulus equally often in each task"""
+    per = trials // (2 * N_STIM)
+    return pd.DataFrame({"task": np.repeat(["a", "b"], trials // 2),
+                         "stim": np.tile(np.repeat(np.arange(N_STIM), per), 2),
+                         "colour": np.arange(trials) % 3})
+
+
+def _shuffle_rows(trials, rng):
+    df = _stim_df(trials)
+    res = funx_10.noStimRepetition(trials, list(range(N_STIM)), rng=rng)
+    return lambda: funx_10.shuffle_rows(res, df, "stim", rng)
+
+
+def _df_boolean_order(trials, rng):
+    df = _stim_df(trials)
+    seqs = funx_10.orderStimWithinTasks_str(trials, list(range(N_STIM)), ["a", "b"], rng=rng)
+    return lambda: funx_10.DfBooleanOrder(df, "stim", seqs["stim"], "task", seqs["task"], rng)
+
+
+# name: (step the length must be a multiple of, setup returning the call)
+CASES = {
+    "balanceTransitionsMinus1": (2, lambda t, rng: lambda: funx_10.balanceTransitionsMinus1(t, rng)),
+    "noStimRepetition": (N_STIM, lambda t, rng: lambda: funx_10.noStimRepetition(t, list(range(N_STIM)), rng=rng)),
+    "orderStimWithinTasks_str": (2 * N_STIM, lambda t, rng: lambda: funx_10.orderStimWithinTasks_str(t, list(range(N_STIM)), ["a", "b"], rng=rng)),
+    "balanceNMinus2_str": (6, lambda t, rng: lambda: funx_10.balanceNMinus2_str(t, "a", "b", "c", rng)),
+    "exact_repetition_proportion": (2, lambda t, rng: lambda: funx_10.exact_repetition_proportion(t, 0.5, "a", "b", rng)),
+    "shuffle_rows": (2 * N_STIM, _shuffle_rows),
+    "DfBooleanOrder": (2 * N_STIM, _df_boolean_order),
+}
+
+
+def run_benchmarks(names=None, sizes=SIZES, repeat=5, seed=2020):
+    """time every function at every length
+
+    Parameters
+    ----------
+    names: list of str, optional
+        functions to benchmark (keys of CASES), all by default
+    sizes: list of int
+        the lengths, rounded down to what each function accepts
+    repeat: int
+        calls timed per function and length; lengths above 10^4 get fewer
+    seed: int
+        seed of the rng passed to the functions
+
+    Returns
+    -------
+    dict
+        versions, date and one result per function and length: best and
+        median wall time (s), peak memory (bytes), mean retries and
+        repair swaps of a call (None for functions without statistics)
+    """
+    rng = np.random.default_rng(seed)
+    results = []
+    for name in names or CASES:
+        step, setup = CASES[name]
+        for size in sizes:
+            trials = max(step, size - size % step)
+            call = setup(trials, rng)
+            call()  # warm up
+            times = []
+            with collect_stats() as records:
+                for r in range(max(1, min(repeat, repeat * 10000 // trials))):
+                    start = time.perf_counter()
+                    call()
+                    times.append(time.perf_counter() - start)
+            # the pandas versions are recorded as the _codes function they call
+            stats = summarize(records)
+            stats = stats.get(name, stats.get(name.replace("_str", "") + "_codes", {}))
+            # on a separate call: tracing slows numpy and pandas down
+            tracemalloc.start()
+            call()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results.append({"function": name, "trials": trials, "calls": len(times),
+                            "best": min(times), "median": float(np.median(times)),
+                            "peak_bytes": peak,
+                            "mean_retries": stats.get("mean_retries"),
+                            "mean_swaps": stats.get("mean_swaps_accepted")})
+            print("%-28s %7d  %10.5f s  %9.1f kB" % (name, trials, min(times), peak / 1024))
+    return {"python": platform.python_version(), "numpy": np.__version__,
+            "pandas": pd.__version__, "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "results": results}
+
+
+def compare(current, baseline, tolerance=1.25):
+    """results slower than the baseline
+
+    Parameters
+    ----------
+    current, baseline: dicts returned by run_benchmarks
+    tolerance: float
+        a result is slower if its best time is above tolerance times the
+        baseline's
+
+    Returns
+    -------
+    list
+        (function, trials, baseline best, current best) of the slower ones
+    """
+    before = {(r["function"], r["trials"]): r["best"] for r in baseline["results"]}
+    slower = []
+    for r in current["results"]:
+        key = (r["function"], r["trials"])
+        if key in before and r["best"] > tolerance * before[key]:
+            slower.append(key + (before[key], r["best"]))
+    return slower
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the funx_10 generators")
+    parser.add_argument("--functions", nargs="+", choices=list(CASES), help="functions to benchmark, all by default")
+    parser.add_argument("--sizes", nargs="+", type=int, default=SIZES, help="sequence lengths")
+    parser.add_argument("--repeat", type=int, default=5, help="timed calls per function and length")
+    parser.add_argument("--out", default="benchmark.json", help="JSON file of the results")
+    parser.add_argument("--baseline", default=BASELINE, help="JSON file of previous results to compare with, benchmark_baseline.json by default")
+    parser.add_argument("--update-baseline", action="store_true", help="save the results as the baseline instead of comparing with it")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="slowdown allowed with respect to the baseline")
+    args = parser.parse_args()
+    current = run_benchmarks(args.functions, args.sizes, args.repeat)
+    with open(args.out, "w") as f:
+        json.dump(current, f, indent=1)
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(current, f, indent=1)
+        print("baseline saved in " + args.baseline)
+    elif not os.path.exists(args.baseline):
+        print("no baseline in " + args.baseline + ": run with --update-baseline to create it")
+    else:
+        with open(args.baseline) as f:
+            slower = compare(current, json.load(f), args.tolerance)
+        for name, trials, before, now in slower:
+            print("slower: %s with %d trials, %.5f s -> %.5f s" % (name, trials, before, now))
+        if slower:
+            sys.exit(1)
@@ -0,0 +1,217 @@
+"""Declarative constraints on sequences, enforced by a shared local search.
+
+Instead of hard-coding the checks and the repair of each generator, the
+constraints of a sequence are listed as rules, e.g.
+
+    rules = [no_repeat(lag=1), balance(lag=2, tol=2)]
+
+and a sequence is brought to satisfy all of them by local_search, which
+swaps pairs of elements. Swaps keep the number of each element, so equal
+counts are preserved by construction, and a swap can be restricted to
+positions of the same group (e.g. the same task) to keep stimuli locked to
+their tasks. The score of a sequence only depends on its n-lag repetition
+counts, which a swap changes in at most 4 transitions per lag: each swap is
+scored in constant time.
+
+This file can also be imported as a module and contains the following
+functions:
+
+    * no_repeat
+    * balance
+    * compile_constraints
+    * local_search
+"""
+
+import numpy as np
+import funx_stats
+
+
+def no_repeat(lag=1, weight=10):
+    """rule: no element equal to the one lag positions before
+
+    Parameters
+    ----------
+    lag: int
+        1 for no n-1 repetitions, 2 for no n-2 repetitions...
+    weight: int
+        cost of each repetition, higher than the other rules' weights to
+        enforce this rule first
+
+    Returns
+    -------
+    dict
+        the rule, to be listed in the rules of local_search
+    """
+    return {"rule": "no_repeat", "lag": lag, "weight": weight}
+
+
+def balance(lag=1, tol=1, weight=1):
+    """rule: almost as many n-lag repetitions as n-lag switches
+
+    Parameters
+    ----------
+    lag: int
+        1 for n-1 transitions, 2 for n-2 transitions
+    tol: int
+        largest |repetitions - switches| allowed
+    weight: int
+        cost of each unit of |repetitions - switches| above tol
+
+    Returns
+    -------
+    dict
+        the rule, to be listed in the rules of local_search
+    """
+    return {"rule": "balance", "lag": lag, "tol": tol, "weight": weight}
+
+
+def compile_constraints(rules, n):
+    """turn the rules into a scorer of repetition counts
+
+    Parameters
+    ----------
+    rules: list of rules made by no_repeat and balance
+    n: the length of the sequences to score (int)
+
+    Returns
+    -------
+    tuple
+        the list of lags the rules depend on; a function that takes the
+        number of repetitions at each of those lags (same order) and returns
+        the score, 0 when every rule is satisfied
+    """
+    lags = sorted({r["lag"] for r in rules})
+    terms = []
+    for r in rules:
+        if r["rule"] not in ("no_repeat", "balance"):
+            raise ValueError("unknown rule " + str(r["rule"]))
+        if r["lag"] <= 0 or r["lag"] >= n:
+            raise ValueError("the lag of a rule must be between 1 and the length of the sequence - 1.")
+        # (position of the lag, weight, transitions at that lag, tolerance)
+        tol = r["tol"] if r["rule"] == "balance" else None
+        terms.append((lags.index(r["lag"]), r["weight"], n - r["lag"], tol))
+
+    def score(reps):
+        total = 0
+        for k, weight, transitions, tol in terms:
+            if tol is None:
+                total += weight * reps[k]
+            else:
+                # repetitions - switches
+                total += weight * max(0, abs(2*reps[k] - transitions) - tol)
+        return total
+    return lags, score
+
+
+def _swap_reps(seq, i, j, lag):
+    """change in the n-lag repetitions if seq[i] and seq[j] were swapped"""
+    n = len(seq)
+    vi = seq[i]
+    vj = seq[j]
+    delta = 0
+    # the only transitions that change start at i-lag, i, j-lag or j
+    for a in {i - lag, i, j - lag, j}:
+        b = a + lag
+        if a < 0 or b >= n:
+            continue
+        before = seq[a] == seq[b]
+        va = vj if a == i else vi if a == j else seq[a]
+        vb = vj if b == i else vi if b == j else seq[b]
+        delta += (va == vb) - before
+    return delta
+
+
+def local_search(seq, rules, groups=None, rng=None, maxIter=None):
+    """swap elements of seq until every rule is satisfied
+
+    At each step two positions (of the same group, if groups is given) are
+    drawn and swapped if the score does not get worse. When a no_repeat rule
+    is violated the first position is taken from one of the repetitions, so
+    that the proposals focus where they are needed.
+
+    Parameters
+    ----------
+    seq: the starting sequence (list or 1-D np.array), it is not modified
+    rules: list of rules made by no_repeat and balance
+    groups: list or 1-D np.array, optional
+        same length as seq; only positions with the same group are swapped
+    rng: the np.random.Generator to draw from, or an int seed (optional)
+    maxIter: int, optional
+        largest number of proposed swaps, defaults to 200 * len(seq)
+
+    Returns
+    -------
+    list
+        np.array with the final sequence; its score (0 if all the rules are
+        satisfied); the number of accepted swaps
+    """
+    rng = np.random.default_rng(rng)
+    arr = np.asarray(seq)
+    seq = arr.tolist()
+    n = len(seq)
+    if maxIter is None:
+        maxIter = 200 * n
+    lags, score = compile_constraints(rules, n)
+    reps = [sum(seq[a] == seq[a+lag] for a in range(n - lag)) for lag in lags]
+    current = score(reps)
+    # positions of each group, and where each position stands in its group
+    if groups is None:
+        groups = [0] * n
+    else:
+        groups = np.asarray(groups).tolist()
+    members = {}
+    for p in range(n):
+        members.setdefault(groups[p], []).append(p)
+    # start of every repeated transition, per no_repeat lag, as a list plus
+    # the index of each start in it, to draw and update them in O(1)
+    repeatLags = sorted({r["lag"] for r in rules if r["rule"] == "no_repeat"})
+    bad = {}
+    for lag in repeatLags:
+        starts = [a for a in range(n - lag) if seq[a] == seq[a+lag]]
+        bad[lag] = (starts, {a: k for k, a in enumerate(starts)})
+    swaps = 0
+    it = 0
+    while current > 0 and it < maxIter:
+        it += 1
+        # first position: from a repetition if there's one, else anywhere
+        i = -1
+        for lag in repeatLags:
+            starts = bad[lag][0]
+            if starts:
+                a = starts[int(rng.random() * len(starts))]
+                i = a if rng.random() < 0.5 else a + lag
+                break
+        if i < 0:
+            i = int(rng.random() * n)
+        group = members[groups[i]]
+        j = group[int(rng.random() * len(group))]
+        if seq[i] == seq[j]:
+            continue
+        newReps = [reps[k] + _swap_reps(seq, i, j, lag) for k, lag in enumerate(lags)]
+        newScore = score(newReps)
+        if newScore > current:
+            continue
+        seq[i], seq[j] = seq[j], seq[i]
+        reps = newReps
+        current = newScore
+        swaps += 1
+        for lag in repeatLags:
+            starts, where = bad[lag]
+            for a in {i - lag, i, j - lag, j}:
+                if a < 0 or a + lag >= n:
+                    continue
+                isBad = seq[a] == seq[a+lag]
+                if isBad and a not in where:
+                    where[a] = len(starts)
+                    starts.append(a)
+                elif not isBad and a in where:
+                    # move the last start in the place of the removed one
+                    k = where.pop(a)
+                    last = starts.pop()
+                    if last != a:
+                        starts[k] = last
+                        where[last] = k
+    stats = funx_stats.current()
+    stats.add("swaps_tried", it)
+    stats.add("swaps_accepted", swaps)
+    return [np.array(seq, dtype=arr.dtype), current, swaps]
@@ -0,0 +1,305 @@
+"""Decide up front whether a sequence can be generated, and how easily.
+
+Some requests cannot be satisfied at all, e.g. a stimulus in more than half
+of a sequence without n-1 repetitions, or orderStimWithinTasks_str with a
+single stimulus; others only by few of the random sequences a function
+starts from. Instead of finding out after many retries, the functions below
+decide from the counts and the constraints whether a valid sequence exists
+and estimate the acceptance rate: the probability that a random attempt
+satisfies the constraints (a random shuffle of the elements, or one attempt
+of the function for stim_feasibility). Each returns a dict with
+
+    feasible: bool
+    reason: str, why the request is infeasible (None if feasible)
+    acceptance: float, 0 when infeasible
+
+e.g. analyze(noStimRepetition, 32, ["a", "a", "b", "c"]) (where "a" is half
+of the sequence, the counts [16, 8, 8]) or no_repeat_feasibility([20, 6, 6]). The acceptance rates are exact where the
+valid sequences can be counted (for short sequences), approximations
+otherwise.
+
+This file can also be imported as a module and contains the following
+functions:
+
+    * no_repeat_feasibility
+    * transitions_feasibility
+    * transitionsK_feasibility
+    * nMinus2_feasibility
+    * two_stim_feasible
+    * stim_feasibility
+    * analyze
+"""
+
+import math
+import numpy as np
+
+# longest sequence whose valid sequences are counted exactly
+EXACT_MAX_TRIALS = 400
+
+
+def _result(feasible, reason=None, acceptance=0.0):
+    if feasible:
+        return {"feasible": True, "reason": None, "acceptance": acceptance}
+    return {"feasible": False, "reason": reason, "acceptance": 0.0}
+
+
+def _log_multinomial(counts):
+    return math.lgamma(sum(counts) + 1) - sum(math.lgamma(n + 1) for n in counts)
+
+
+def _no_repeat_count(counts):
+    """number of arrangements of the counts without two equal neighbours
+
+    Inclusion-exclusion on the blocks each element is cut into: ways[K] is
+    the signed number of ways to arrange K blocks of the elements so far.
+    """
+    ways = [1]
+    for n in counts:
+        if n == 0:
+            continue
+        new = [0] * (len(ways) + n)
+        for K, w in enumerate(ways):
+            if w == 0:
+                continue
+            for k in range(1, n + 1):
+                new[K + k] += w * math.comb(K + k, k) * math.comb(n - 1, k - 1) * (-1)**(n - k)
+        ways = new
+    return sum(ways)
+
+
+def no_repeat_feasibility(counts):
+    """sequence with counts[i] times element i and no n-1 repetitions
+
+    as noStimRepetition
+
+    Parameters
+    ----------
+    counts: list of int, the times each element appears
+
+    Returns
+    -------
+    dict
+        feasible, reason and acceptance: the probability that a random
+        shuffle of the elements has no n-1 repetitions
+    """
+    counts = [int(n) for n in counts if n > 0]
+    trials = sum(counts)
+    if trials == 0:
+        return _result(False, "the sequence is empty.")
+    if max(counts) > (trials + 1)//2:
+        return _result(False, "an element appears " + str(max(counts)) + " times, more than half of the " + str(trials) + " trials.")
+    if trials <= EXACT_MAX_TRIALS:
+        acceptance = _no_repeat_count(counts) / math.exp(_log_multinomial(counts))
+    else:
+        # the number of repetitions of a shuffle is about Poisson
+        acceptance = math.exp(-sum(n*(n - 1) for n in counts) / trials)
+    return _result(True, acceptance=min(1.0, acceptance))
+
+
+def _runs_count(n0, n1, runs):
+    """number of sequences of n0 0s and n1 1s with that many runs"""
+    k, odd = divmod(runs, 2)
+    if not odd:
+        return 2 * math.comb(n0 - 1, k - 1) * math.comb(n1 - 1, k - 1)
+    return math.comb(n0 - 1, k) * math.comb(n1 - 1, k - 1) + math.comb(n0 - 1, k - 1) * math.comb(n1 - 1, k)
+
+
+def transitions_feasibility(trials, nRep=None):
+    """sequence of trials/2 0s and 1s with balanced n-1 transitions, or with
+    exactly nRep repetitions
+
+    as balanceTransitionsMinus1 (nRep None) and exact_repetition_proportion
+
+    Parameters
+    ----------
+    trials: the lenght of the sequence (int)
+    nRep: int, optional
+        the number of repetitions wanted
+
+    Returns
+    -------
+    dict
+        feasible, reason and acceptance: the probability that a random
+        shuffle of the 0s and 1s has the wanted transitions
+    """
+    if type(trials) != int or trials <= 0 or trials%2 != 0:
+        return _result(False, "trials must be an even integer greater than 0.")
+    if nRep is not None and not 0 <= nRep <= trials - 2:
+        return _result(False, "a sequence of " + str(trials) + " trials has between 0 and " + str(trials - 2) + " repetitions.")
+    half = trials//2
+    # each run but the first adds a switch
+    runs = [half, half + 1] if nRep is None else [trials - nRep]
+    valid = sum(_runs_count(half, half, r) for r in runs)
+    return _result(True, acceptance=valid / math.comb(trials, half))
+
+
+def transitionsK_feasibility(trials, nTasks, repetitions=True):
+    """sequence of nTasks tasks with every ordered pair equally often
+
+    as balanceTransitionsK
+
+    Returns
+    -------
+    dict
+        feasible, reason and acceptance: the probability that a random
+        shuffle of the same tasks is balanced
+    """
+    if type(trials) != int or type(nTasks) != int or nTasks < 2:
+        return _result(False, "trials and nTasks must be integers, nTasks 2 or greater.")
+    nPairs = nTasks**2 if repetitions else nTasks*(nTasks - 1)
+    if trials < nPairs + 1 or (trials - 1)%nPairs != 0:
+        return _result(False, "trials - 1 must be a multiple of the " + str(nPairs) + " pairs of tasks.")
+    times = (trials - 1)//nPairs
+    degree = times * (nTasks if repetitions else nTasks - 1)
+    # BEST theorem: spanning trees towards a task times the orders of the
+    # other exits of each task, then the parallel transitions are unlabelled
+    logTrees = (nTasks - 1)*math.log(times) + (nTasks - 2)*math.log(nTasks)
+    logValid = logTrees + nTasks*math.lgamma(degree) + math.log(degree) - nPairs*math.lgamma(times + 1)
+    # the first (and last) task appears once more than the others
+    logShuffles = _log_multinomial([degree + 1] + [degree]*(nTasks - 1))
+    return _result(True, acceptance=min(1.0, math.exp(logValid - logShuffles)))
+
+
+def nMinus2_feasibility(trials, tol=1):
+    """sequence of 3 tasks, each trials/3 times, without n-1 repetitions and
+    with |n-2 repetitions - n-2 switches| <= tol
+
+    as balanceNMinus2_str (tol=1) and balanceNMinus2_exact
+
+    Returns
+    -------
+    dict
+        feasible, reason and acceptance: the probability that a random
+        sequence without n-1 repetitions also has balanced n-2 transitions
+    """
+    if type(trials) != int or trials < 3 or trials%3 != 0:
+        return _result(False, "trials must be a multiple of 3 greater than 0.")
+    if type(tol) != int or tol < 0:
+        return _result(False, "tol must be an integer, 0 or greater.")
+    if trials == 3:
+        # a single n-2 transition, always a switch
+        return _result(tol >= 1, "the only n-2 transition of 3 trials is a switch.", 1.0)
+    m = trials//3
+    transitions = trials - 2
+    if trials <= 96:
+        from nminus2_tables import count_table, _rep_bounds
+        table = count_table(trials, tol, None)
+        # 6 first pairs of different tasks with the same number of endings
+        valid = 6 * int(table[m - 1, m - 1, m, _rep_bounds(trials, tol)[1]])
+        return _result(valid > 0, "no sequence has the n-2 transitions balanced within " + str(tol) + ".", valid / _no_repeat_count([m, m, m]))
+    # without n-1 repetitions each n-2 transition is a repetition or a
+    # switch, about as often: |rep - sw| is about normal
+    allowed = sum(1 for d in range(-tol, tol + 1) if (d - transitions)%2 == 0)
+    return _result(True, acceptance=min(1.0, allowed * 2 / math.sqrt(2*math.pi*transitions)))
+
+
+def two_stim_feasible(taskIdx, nTasks):
+    """whether 2 stimuli can be assigned to the task codes taskIdx without
+    n-1 repetitions and equally often within each task
+
+    With 2 stimuli and no repetitions the stimuli alternate, so each task
+    needs as many even as odd positions.
+    """
+    taskIdx = np.asarray(taskIdx)
+    return bool((np.bincount(taskIdx[0::2], minlength=nTasks) == np.bincount(taskIdx[1::2], minlength=nTasks)).all())
+
+
+def stim_feasibility(trials, nStim, nTasks=2, taskSeq=None, samples=100, rng=None):
+    """stimuli assigned to tasks as in orderStimWithinTasks_str
+
+    Parameters
+    ----------
+    trials: the lenght of the sequence (int)
+    nStim: number of stimuli (int)
+    nTasks: number of tasks (int), 2 if taskSeq is not given
+    taskSeq: list or np.array, optional
+        the task sequence (ready_taskSeq), else a new one is drawn for each
+        sample as the function does
+    samples: int
+        attempts of the function drawn to estimate the acceptance
+    rng: the np.random.Generator to draw from, or an int seed (optional)
+
+    Returns
+    -------
+    dict
+        feasible, reason and acceptance: the fraction of the samples in
+        which one attempt of the function succeeds
+    """
+    # imported here, funx_10 imports this module
+    from funx_10 import balanceTransitionsMinus1, _assign_stim
+    rng = np.random.default_rng(rng)
+    if taskSeq is not None:
+        taskVals, taskIdx = np.unique(taskSeq, return_inverse=True)
+        nTasks = len(taskVals)
+        if len(taskIdx) != trials:
+            return _result(False, "the task sequence must contain trials elements.")
+        if len(set(np.bincount(taskIdx).tolist())) != 1:
+            return _result(False, "each task must appear the same number of times in the task sequence.")
+    elif nTasks != 2:
+        return _result(False, "a task sequence must be given for other than 2 tasks.")
+    if nStim < 1 or trials%(nTasks*nStim) != 0:
+        return _result(False, "the number of stimuli must be a divisor of trials/number of tasks.")
+    if nStim == 1 and trials > 1:
+        return _result(False, "a single stimulus is repeated in every trial.")
+    if taskSeq is not None and nStim == 2 and not two_stim_feasible(taskIdx, nTasks):
+        return _result(False, "with 2 stimuli, each task needs as many trials in even as in odd positions.")
+    accepted = 0
+    for s in range(samples):
+        if taskSeq is None:
+            taskIdx = balanceTransitionsMinus1(trials, rng)[0]
+        accepted += _assign_stim(np.asarray(taskIdx, dtype=np.int32), nTasks, nStim, rng) is not None
+    return _result(True, acceptance=accepted / samples)
+
+
+def analyze(func, *args, **kwargs):
+    """feasibility of calling func with these arguments, without calling it
+
+    Parameters
+    ----------
+    func: a function of funx_10 (noStimRepetition, balanceTransitionsMinus1,
+        exact_repetition_proportion, balanceTransitionsK,
+        balanceNMinus2_str, orderStimWithinTasks_str and their variants)
+    *args, **kwargs: the arguments of func
+
+    Returns
+    -------
+    dict
+        feasible, reason and acceptance, see the functions above
+    """
+    import inspect
+    call = inspect.signature(func).bind(*args, **kwargs)
+    call.apply_defaults()
+    a = call.arguments
+    name = func.__name__.replace("_codes", "").replace("_str", "")
+    if name == "noStimRepetition":
+        if len(a["stimLst"]) > 0:
+            return no_repeat_feasibility(np.unique(a["stimLst"], return_counts=True)[1])
+        if a["trials"]%len(a["stimElmns"]) != 0:
+            return _result(False, "the number of elements must be a divisor of trials.")
+        # an element listed k times is k times as frequent, as in noStimRepetition
+        copies = {}
+        for i in a["stimElmns"]:
+            copies[i] = copies.get(i, 0) + 1
+        return no_repeat_feasibility([k * (a["trials"]//len(a["stimElmns"])) for k in copies.values()])
+    if name in ("balanceTransitionsMinus1", "balanceTransitionsMinus1_batch"):
+        return transitions_feasibility(a["trials"])
+    if name == "exact_repetition_proportion":
+        return transitions_feasibility(a["trials"], min(math.floor(a["trials"]*a["percent_rep"]), a["trials"] - 2))
+    if name == "balanceTransitionsK":
+        nTasks = a["nTasks"] if "nTasks" in a else len(a["Tasks"])
+        return transitionsK_feasibility(a["trials"], nTasks, a["repetitions"])
+    if name in ("balanceNMinus2", "balanceNMinus2_exact"):
+        if name == "balanceNMinus2" and a["trials"]%2 != 0:
+            return _result(False, "trials must be an even integer.")
+        return nMinus2_feasibility(a["trials"], a.get("tol", 1))
+    if name == "orderStimWithinTasks":
+        taskSeq = a["ready_taskSeq"] if len(a.get("ready_taskSeq", [])) > 0 else None
+        return stim_feasibility(a["trials"], len(a["stimElmns"]), len(a.get("Tasks", [0, 1])), taskSeq, rng=a.get("rng"))
+    raise ValueError("no feasibility analysis for " + func.__name__ + ".")
+
+# from funx_10 import noStimRepetition, orderStimWithinTasks_str
+# print(analyze(noStimRepetition, 32, ["a", "b", "c", "d"]))
+# # "a" is half of the list: scored as the counts [16, 8, 8]
+# assert analyze(noStimRepetition, 32, ["a", "a", "b", "c"]) == no_repeat_feasibility([16, 8, 8])
+# print(no_repeat_feasibility([20, 6, 6]))
+# print(analyze(orderStimWithinTasks_str, 96, [1, 2], ["a", "b"]))
@@ -10,162 +10,169 @@ elements (repetition, switch in subsequent positions).
 Other functions allow to randomize the rows of custom dataframes to match the
 sequences generated with the pseudorandomizing functions
 
+Importing this file only imports numpy: pandas is imported by the first call
+that returns a Series or DataFrame. The _codes functions are the numpy-only
+versions of the _str ones, they return integer codes and the table of their
+labels (sequence = labels[codes]). The _str functions take an encoding
+argument to return their labels as pandas categoricals or as codes and labels.
+
 This file can also be imported as a module and contains the following
 functions:
 
     * balanceTransitionsMinus1
+    * balanceTransitionsMinus1_batch
     * balanceTransitionsMinus2 - not very useful
     * balanceTransitionsMinus1_str
+    * balanceTransitionsK
+    * balanceTransitionsK_str
     * orderStimWithinTasks
+    * orderStimWithinTasks_codes
     * orderStimWithinTasks_str
+    * counterbalanceParticipants
+    * noStimRepetition_codes
     * noStimRepetition
     * shuffle_rows
     * DfBooleanOrder
+    * DfOrder
+    * balanceNMinus2_codes
     * balanceNMinus2_str - still developing
+    * balanceNMinus2_exact
     * exact_repetition_proportion
 """
 
-import random, numpy as np
-import pandas as pd
-from random import randint
-import timeit
-#myDir = "C:\\Users\\Elena\\Documents\\AA_PhD\\PsychoPy\\"
-myDir = "C:\\Users\\Elena\\Documents\\PsychoPy\\"
+import math
+import numpy as np
+from transition_stats import count_labels, transition_counts, run_lengths
+from constraints import no_repeat, balance, local_search
+from nminus2_tables import sample_nMinus2
+from funx_stats import track, current
+from feasibility import two_stim_feasible
+
+
+def _pandas():
+    """pandas, imported by the first call that returns a Series or DataFrame"""
+    import pandas
+    return pandas
+
+
+ENCODINGS = (None, "category", "codes")
+
+
+def _check_encoding(encoding):
+    if encoding not in ENCODINGS:
+        raise ValueError("encoding must be one of " + str(ENCODINGS) + ".")
+
 
+def _encode(codes, labels, encoding):
+    """the sequence of labels[codes] in the wanted encoding
 
-def balanceTransitionsMinus1(trials):
+    "category": a pd.Categorical with labels as categories, stored as the
+    codes (no object per element); "codes": the pair (codes, labels)
+    """
+    if len(set(labels.tolist())) != len(labels):
+        raise ValueError("the labels must be all different to be encoded, got " + str(list(labels)) + ".")
+    if encoding == "codes":
+        return (codes, labels)
+    return _pandas().Categorical.from_codes(codes, labels)
+
+
+def _log_compositions(total, parts):
+    """log of the number of ways to split total elements into parts runs"""
+    if parts == 0:
+        return 0.0 if total == 0 else -math.inf
+    if parts > total:
+        return -math.inf
+    # (total-1 choose parts-1)
+    return math.lgamma(total) - math.lgamma(parts) - math.lgamma(total - parts + 1)
+
+def _composition(total, parts, rng):
+    """lengths of parts runs summing to total, uniformly drawn"""
+    if parts == 0:
+        return np.zeros(0, dtype=int)
+    cuts = np.sort(rng.choice(total - 1, parts - 1, replace=False)) + 1
+    return np.diff(np.concatenate(([0], cuts, [total])))
+
+def _runs_layout(n0, n1, nRunsOptions, rng):
+    """number of runs and first element of a sequence of n0 0s and n1 1s
+
+    Drawn proportionally to the number of sequences having them.
+    """
+    options = [(nRuns, first) for nRuns in nRunsOptions for first in (0, 1)]
+    logCounts = []
+    for nRuns, first in options:
+        sizes = (n0, n1) if first == 0 else (n1, n0)
+        # runs alternate, the first element has the extra run if nRuns is odd
+        logCounts.append(_log_compositions(sizes[0], (nRuns+1)//2) + _log_compositions(sizes[1], nRuns//2))
+    logCounts = np.array(logCounts)
+    if np.isneginf(logCounts).all():
+        raise ValueError("no sequence of " + str(n0) + " 0s and " + str(n1) + " 1s has " + str(list(nRunsOptions)) + " runs.")
+    weights = np.exp(logCounts - logCounts.max())
+    return options[rng.choice(len(options), p=weights/weights.sum())]
+
+def _sample_runs(n0, n1, nRunsOptions, rng):
+    """sequence of n0 0s and n1 1s with a number of runs in nRunsOptions
+
+    Every sequence satisfying the constraints is equally likely: the number of
+    runs and the first element are drawn proportionally to the number of
+    sequences having them, then the lengths of the runs of 0s and of the runs
+    of 1s are drawn uniformly.
+    """
+    nRuns, first = _runs_layout(n0, n1, nRunsOptions, rng)
+    sizes = (n0, n1) if first == 0 else (n1, n0)
+    lengths = np.empty(nRuns, dtype=int)
+    lengths[0::2] = _composition(sizes[0], (nRuns+1)//2, rng)
+    lengths[1::2] = _composition(sizes[1], nRuns//2, rng)
+    values = np.empty(nRuns, dtype=int)
+    values[0::2] = first
+    values[1::2] = 1 - first
+    return np.repeat(values, lengths)
+
+def balanceTransitionsMinus1(trials, rng=None):
     """Balance n-1 repetitions and switches
 
     Generating a sequence of 0 and 1 of desired length, such that number of 0 = number of 1 and the delta
     (N-1 repetitions) - (N-1 switches) is less than 1, in absolute value.
 
+    The sequence is built directly from its runs of 0s and 1s: a sequence
+    with trials/2 0s and 1s is balanced when it has trials/2 or trials/2 + 1
+    runs. Every balanced sequence is equally likely and no retry is needed.
+
     Parameters
     ----------
     trials: the lenght of the needed sequence (int)
+    rng: the np.random.Generator to draw from, or an int seed (optional)
 
     Returns
     -------
     list
         np.array of length = trials; the number of repetions; number of switches
     """
-
-    maxCounter = 4
-    if type(trials) != int or type(maxCounter) != int:
-        raise ValueError("trials and maxCounter must be of type integer.")
+    rng = np.random.default_rng(rng)
+    if type(trials) != int:
+        raise ValueError("trials must be of type integer.")
     if trials%2 != 0:
         raise ValueError("trials argument must be an even integer.")
-    if maxCounter <= 0 or trials <= 0:
-        raise ValueError("maxCounter and trials must both be greater than 0.")
-    seq_Completed = 0
-    counter = 0
-    while seq_Completed == 0 and counter <= maxCounter:
-        lst = np.repeat([0, 1], trials/2)
-        perm = np.random.permutation(trials)
-        seq = lst[perm]
-        rep=0
-        sw=0
-        zeross = 0
-        oness = 0
-        #count 0s and ones
-        for i in range(trials):
-            if seq[i] == 0:
-                zeross +=1
-            else:
-                oness +=1
-        #print("there are " + str(zeross) + " zeros and " + str(oness) + " ones")
-        #count sw and repetition
-        for i in range(trials-1):
-            if seq[i] == seq[i+1]:
-                rep +=1
-            else:
-                sw +=1
-        diff = rep-sw
-        #print("repetition " + str(rep) + " switch " + str(sw))
-        if rep == 0: # when the sequence is 010101... or 101010 I switch the first two elements
-            seq[0] = seq[1]
-            seq[1] = seq[2]
-        if diff > 1: # if more rep than sw and delta greater than 1
-            Rounds = ((diff - 2) // 4) + 1 # how many rounds I need to fix the imbalance
-            #print(str(Rounds))
-            for j in range(1, Rounds+1):
-                #print("we are in more rep situation")
-                strt = randint(0, trials-1) # I start from a random position in the sequence
-                success = 0
-                for i in range(trials-3): #I loop over the sequence
-                    if success == 1:
-                        break
-                    else:
-                        ind = (strt+i)%(trials-2) # increment position
-                        if (seq[ind] == seq[ind+1] and seq[ind+1] == seq[ind+2]): #111 o 000
-                            first = ind # save first position of the triplet
-                            change = ind+1 # save the position to be changed
-                            strt1 = randint(0, trials-1)
-                            #print("first triplet " + str(seq[first]) + str(seq[change]) + str(seq[first+2]))
-                            for k in range(trials-3): #I loop over the sequence
-                                ind = (strt1+k)%(trials-2) # increment position
-                                # look for 100 o 001 o ( 011 o 110)
-                                if (seq[ind] == seq[first] and seq[ind+1] != seq[first] and seq[ind+2] != seq[first]) or (seq[ind] != seq[first] and seq[ind+1] != seq[first] and seq[ind+2] == seq[first]): # look for 100 o 001 o ( 011 o 110)
-                                    #print("second triplet " + str(seq[ind]) + str(seq[ind+1]) + str(seq[ind+2]))
-                                    temp = seq[change]
-                                    seq[change] = seq[ind+1] #swap middle elements of the 2 triplets
-                                    seq[ind+1] = temp
-                                    success = 1
-                                    break
-        if diff < -1: # if more switches and again delta greater than 1
-            Rounds = ((abs(diff) - 2) // 4) + 1 # how many rounds I need to fix the imbalance
-            #print(str(Rounds))
-            for j in range(1, Rounds+1):
-                #print("we are in more sw situation")
-                strt = randint(0, trials-1) # I start from a random position in the sequence
-                success = 0
-                for i in range(trials-3): #I loop over the sequence
-                    if success == 1:
-                        break
-                    else:
-                        ind = (strt+i)%(trials-2) # increment position
-                        if (seq[ind] != seq[ind+1] and seq[ind] == seq[ind+2]): # look for 101 or 010
-                            first = ind # save first position of the triplet
-                            change = ind+1 # save the position to be changed
-                            #print("first triplet " + str(seq[first]) + str(seq[change]) + str(seq[first+2]))
-                            strt1 = randint(0, trials-1)
-                            for k in range(trials-3): #I loop over the sequence
-                                ind = (strt1+k)%(trials-2) # increment position
-                                if ind != change and ind != first -1: # ensure it doesn't step on the first triplet. There cannot be overlap in the searched triplet in the "more rep" case
-                                    #cerca sequenza 110 o 011 o ( 001 o 100)
-                                    if (seq[ind] == seq[first] and seq[ind+1] == seq[first] and seq[ind+2] != seq[first]) or (seq[ind] != seq[first] and seq[ind+1] == seq[first] and seq[ind+2] == seq[first]): # (001 o 100) o (110 o 011)
-                                        #print("second triplet " + str(seq[ind]) + str(seq[ind+1]) + str(seq[ind+2]))
-                                        temp = seq[change]
-                                        seq[change] = seq[ind+1] #swap middle elements of the 2 triplets
-                                        seq[ind+1] = temp
-                                        success = 1
-                                        break
-        #these redudnant tests check integrity of the sequence after the manipulations
-        counter += 1
-        rep=0
-        sw=0
-        zeross = 0
-        oness = 0
-        for i in range(trials):
-            if seq[i] == 0:
-                zeross +=1
-            else:
-                oness +=1
-        if zeross != oness:
-            raise Warning("number of 0s is different from number of 1s")
-        for i in range(1, trials):
-            if seq[i] == seq[i-1]:
-                rep +=1
-            else:
-                sw +=1
-        if abs(rep-sw) == 1  and zeross == oness:
-            seq_Completed=1
-        elif abs(rep-sw) != 1 and counter >= maxCounter+1:
-            raise Warning("N - 1 transitions couldn't be balanced by balanceTransitionsMinus1 function")
-    # if everything ends
-    seqAndDiff = [seq.astype(int), rep, sw]
+    if trials <= 0:
+        raise ValueError("trials must be greater than 0.")
+    with track("balanceTransitionsMinus1") as stats:
+        with stats.phase("shuffle"):
+            # switches = runs - 1, repetitions = trials - runs
+            seq = _sample_runs(trials//2, trials//2, [trials//2, trials//2 + 1], rng)
+        #these redudnant tests check integrity of the sequence
+        with stats.phase("check"):
+            zeross, oness = count_labels(seq, 2)
+            if zeross != oness:
+                raise Warning("number of 0s is different from number of 1s")
+            # the sequence was built from its runs: each run but the first
+            # adds a switch, every other element a repetition
+            runs = len(run_lengths(seq)[1])
+            rep, sw = trials - runs, runs - 1
+            if abs(rep-sw) != 1:
+                raise Warning("N - 1 transitions couldn't be balanced by balanceTransitionsMinus1 function")
+    seqAndDiff = [seq, rep, sw]
     return seqAndDiff
 
-def balanceTransitionsMinus1_str(trials, task0, task1):
+def balanceTransitionsMinus1_str(trials, task0, task1, rng=None, encoding=None):
     """Balance n-1 repetitions and switches
 
     as balanceTransitionsMinus1, only changes 0 and 1 with strings: task0 and
@@ -179,124 +186,26 @@ def balanceTransitionsMinus1_str(trials, task0, task1):
     trials: the lenght of the needed sequence (int)
     task0: a string for your task1 name
     task0: a string for your task2 name
+    rng: the np.random.Generator to draw from, or an int seed (optional)
+    encoding: str, optional
+        None for a list of task names, "category" for a pd.Categorical or
+        "codes" for the pair (array of 0 and 1, array [task0, task1])
 
     Returns
     -------
     list
         the sequence; the number of repetions; number of switches
     """
-    maxCounter = 4
+    rng = np.random.default_rng(rng)
     if type(trials) != int:
         raise ValueError("trials must be of type integer.")
-    if trials%2 != 0:
-        raise ValueError("trials argument must be an even integer.")
-    if trials <= 0:
-        raise ValueError("trials must both be greater than 0.")
-    seq_Completed = 0
-    counter = 0
-    while seq_Completed == 0 and counter <= maxCounter:
-        seq = [task0, task1]* int(trials/2)
-        random.shuffle(seq)
-        rep=0
-        sw=0
-        zeross = 0 # task0
-        oness = 0 # task1
-        #count task0 and task1
-        for i in range(trials):
-            if seq[i] == task0:
-                zeross +=1
-            else:
-                oness +=1
-        #print("there are " + str(zeross) + " zeros and " + str(oness) + " ones")
-        #count sw and repetition
-        for i in range(trials-1):
-            if seq[i] == seq[i+1]:
-                rep +=1
-            else:
-                sw +=1
-        diff = rep-sw
-        #print("repetition " + str(rep) + " switch " + str(sw))
-        if rep == 0: # when the sequence is 010101... or 101010 I switch the first two elements
-            seq[0] = seq[1]
-            seq[1] = seq[2]
-        if diff > 1: # if more rep than sw and delta greater than 1
-            Rounds = ((diff - 2) // 4) + 1 # how many rounds I need to fix the imbalance
-            #print(str(Rounds))
-            for j in range(1, Rounds+1):
-                #print("we are in more rep situation")
-                strt = randint(0, trials-1) # I start from a random position in the sequence
-                success = 0
-                for i in range(trials-3): #I loop over the sequence
-                    if success == 1:
-                        break
-                    else:
-                        ind = (strt+i)%(trials-2) # increment position
-                        if (seq[ind] == seq[ind+1] and seq[ind+1] == seq[ind+2]): #111 o 000
-                            first = ind # save first position of the triplet
-                            change = ind+1 # save the position to be changed
-                            strt1 = randint(0, trials-1)
-                            #print("first triplet " + str(seq[first]) + str(seq[change]) + str(seq[first+2]))
-                            for k in range(trials-3): #I loop over the sequence
-                                ind = (strt1+k)%(trials-2) # increment position
-                                # look for 100 o 001 o ( 011 o 110)
-                                if (seq[ind] == seq[first] and seq[ind+1] != seq[first] and seq[ind+2] != seq[first]) or (seq[ind] != seq[first] and seq[ind+1] != seq[first] and seq[ind+2] == seq[first]): # look for 100 o 001 o ( 011 o 110)
-                                    #print("second triplet " + str(seq[ind]) + str(seq[ind+1]) + str(seq[ind+2]))
-                                    temp = seq[change]
-                                    seq[change] = seq[ind+1] #swap middle elements of the 2 triplets
-                                    seq[ind+1] = temp
-                                    success = 1
-                                    break
-        if diff < -1: # if more switches and again delta greater than 1
-            Rounds = ((abs(diff) - 2) // 4) + 1 # how many rounds I need to fix the imbalance
-            #print(str(Rounds))
-            for j in range(1, Rounds+1):
-                #print("we are in more sw situation")
-                strt = randint(0, trials-1) # I start from a random position in the sequence
-                success = 0
-                for i in range(trials-3): #I loop over the sequence
-                    if success == 1:
-                        break
-                    else:
-                        ind = (strt+i)%(trials-2) # increment position
-                        if (seq[ind] != seq[ind+1] and seq[ind] == seq[ind+2]): # look for 101 or 010
-                            first = ind # save first position of the triplet
-                            change = ind+1 # save the position to be changed
-                            #print("first triplet " + str(seq[first]) + str(seq[change]) + str(seq[first+2]))
-                            strt1 = randint(0, trials-1)
-                            for k in range(trials-3): #I loop over the sequence
-                                ind = (strt1+k)%(trials-2) # increment position
-                                if ind != change and ind != first -1: # ensure it doesn't step on the first triplet. There cannot be overlap in the searched triplet in the "more rep" case
-                                    #cerca sequenza 110 o 011 o ( 001 o 100)
-                                    if (seq[ind] == seq[first] and seq[ind+1] == seq[first] and seq[ind+2] != seq[first]) or (seq[ind] != seq[first] and seq[ind+1] == seq[first] and seq[ind+2] == seq[first]): # (001 o 100) o (110 o 011)
-                                        #print("second triplet " + str(seq[ind]) + str(seq[ind+1]) + str(seq[ind+2]))
-                                        temp = seq[change]
-                                        seq[change] = seq[ind+1] #swap middle elements of the 2 triplets
-                                        seq[ind+1] = temp
-                                        success = 1
-                                        break
-        #these redudnant tests check integrity of the sequence after the manipulations
-        counter += 1
-        rep=0
-        sw=0
-        zeross = 0
-        oness = 0
-        for i in range(trials):
-            if seq[i] == task0:
-                zeross +=1
-            else:
-                oness +=1
-        if zeross != oness:
-            raise Warning("number of " + str(task0) + " is different from number of " + str(task1))
-        for i in range(1, trials):
-            if seq[i] == seq[i-1]:
-                rep +=1
-            else:
-                sw +=1
-        if abs(rep-sw) == 1  and zeross == oness:
-            seq_Completed=1
-        elif abs(rep-sw) != 1 and counter >= maxCounter+1:
-            raise Warning("N - 1 transitions couldn't be balanced by balanceTransitionsMinus1_str function")
-    # if everything ends
+    _check_encoding(encoding)
+    # the balancing works on 0s and 1s, these are replaced by task0 and task1
+    seq, rep, sw = balanceTransitionsMinus1(trials, rng)
+    if encoding is not None:
+        seq = _encode(seq, np.array([task0, task1], dtype=object), encoding)
+    else:
+        seq = np.array([task0, task1], dtype=object)[seq].tolist()
     seqAndDiff = [seq, rep, sw]
     return seqAndDiff # need this one for orderStimWithinTasks!
     #return seq
@@ -313,7 +222,233 @@ def balanceTransitionsMinus1_str(trials, task0, task1):
 #         counter += 1
 # print("times it failed: " + str(counter))
 
-def balanceTransitionsMinus2(trials):
+def _last_exits(nTasks, root, rng):
+    """random spanning tree of the tasks, every edge towards root
+
+    Wilson's algorithm on the complete graph: loop-erased random walks from
+    each task until the tree is reached. next[v] is the task v leads to in the
+    tree (the last transition out of v in the circuit), -1 for the root.
+    """
+    inTree = [False]*nTasks
+    inTree[root] = True
+    nxt = [-1]*nTasks
+    for start in range(nTasks):
+        v = start
+        while not inTree[v]:
+            # a random other task: loops never leave v, so they are skipped
+            u = int(rng.integers(nTasks - 1))
+            nxt[v] = u + (u >= v)
+            v = nxt[v]
+        v = start
+        while not inTree[v]:
+            inTree[v] = True
+            v = nxt[v]
+    return nxt
+
+def balanceTransitionsK(trials, nTasks, repetitions=True, rng=None):
+    """Balance all the n-1 transitions between nTasks tasks
+
+    Generates a sequence of the codes 0, ..., nTasks-1 in which every ordered
+    pair of tasks (a, b), with a != b, follows each other equally often;
+    with repetitions=True the pairs (a, a) too, so that repetitions and each
+    kind of switch are balanced as well.
+
+    The transitions of such a sequence form an Eulerian circuit of the graph
+    with one edge for each wanted transition: the function draws a random
+    tree of last exits (see _last_exits), orders the other transitions out of
+    each task at random and follows them. Every balanced sequence is equally
+    likely and no retry is needed. Since the sequence is a circuit, its first
+    and last elements are the same task, which is therefore one trial more
+    frequent than the others.
+
+    Parameters
+    ----------
+    trials: the lenght of the needed sequence (int): the number of pairs
+        (nTasks**2, or nTasks*(nTasks-1) without repetitions) times the
+        number of times each pair appears, plus 1
+    nTasks: number of tasks (int), at least 2
+    repetitions: bool
+        whether repetitions (a, a) are balanced with the switches or not
+        allowed at all
+    rng: the np.random.Generator to draw from, or an int seed (optional)
+
+    Returns
+    -------
+    list
+        np.array of length = trials; the (nTasks, nTasks) array of the times
+        task row is followed by task column
+    """
+    rng = np.random.default_rng(rng)
+    if type(trials) != int or type(nTasks) != int:
+        raise ValueError("trials and nTasks must be of type integer.")
+    if nTasks < 2:
+        raise ValueError("nTasks must be 2 or greater.")
+    nPairs = nTasks**2 if repetitions else nTasks*(nTasks - 1)
+    if trials < nPairs + 1 or (trials - 1)%nPairs != 0:
+        raise ValueError("trials - 1 must be a multiple of the " + str(nPairs) + " pairs of tasks, e.g. " + str(nPairs*max(1, (trials - 1)//nPairs) + 1) + " trials.")
+    times = (trials - 1)//nPairs
+    with track("balanceTransitionsK") as stats:
+        with stats.phase("shuffle"):
+            root = int(rng.integers(nTasks))
+            nxt = _last_exits(nTasks, root, rng)
+            exits = []
+            for v in range(nTasks):
+                targets = np.repeat(np.arange(nTasks), times)
+                if not repetitions:
+                    targets = targets[targets != v]
+                if v != root:
+                    # the tree edge leaves v last, the others in random order
+                    targets = np.delete(targets, np.flatnonzero(targets == nxt[v])[0])
+                    exits.append(rng.permutation(targets).tolist() + [nxt[v]])
+                else:
+                    exits.append(rng.permutation(targets).tolist())
+            seq = np.empty(trials, dtype=int)
+            seq[0] = v = root
+            pos = [0]*nTasks
+            for t in range(1, trials):
+                u = exits[v][pos[v]]
+                pos[v] += 1
+                seq[t] = v = u
+        with stats.phase("check"):
+            pairs = count_labels(seq[:-1]*nTasks + seq[1:], nTasks**2).reshape(nTasks, nTasks)
+            wanted = np.full((nTasks, nTasks), times)
+            if not repetitions:
+                np.fill_diagonal(wanted, 0)
+            if not (pairs == wanted).all():
+                raise Warning("the transitions between tasks are not balanced")
+    return [seq, pairs]
+
+def balanceTransitionsK_str(trials, Tasks, repetitions=True, rng=None, encoding=None):
+    """Balance all the n-1 transitions between the tasks in Tasks
+
+    as balanceTransitionsK, with the codes replaced by the names in Tasks
+
+    Parameters
+    ----------
+    trials: the lenght of the needed sequence (int), see balanceTransitionsK
+    Tasks: list with tasks names
+    repetitions: bool
+        whether repetitions are balanced with the switches or not allowed
+    rng: the np.random.Generator to draw from, or an int seed (optional)
+    encoding: str, optional
+        None for a list of task names, "category" for a pd.Categorical or
+        "codes" for the pair (codes, array of Tasks)
+
+    Returns
+    -------
+    list
+        the sequence; the (len(Tasks), len(Tasks)) array of transition counts
+    """
+    _check_encoding(encoding)
+    seq, pairs = balanceTransitionsK(trials, len(Tasks), repetitions, rng)
+    labels = np.array(Tasks, dtype=object)
+    if encoding is not None:
+        return [_encode(seq, labels, encoding), pairs]
+    return [labels[seq].tolist(), pairs]
+
+# seq, pairs = balanceTransitionsK(3*3*10 + 1, 3, rng=2020)
+# print(pairs)
+# seq = balanceTransitionsK_str(4*3*4 + 1, ["a", "b", "c", "d"], repetitions=False)[0]
+
+def _pick_true(mask, rng):
+    """random True position in each row of a 2-D boolean mask
+
+    Returns the picked column for each row and whether the row had any True.
+    """
+    keys = np.where(mask, rng.random(mask.shape), -1.0)
+    pick = keys.argmax(axis=1)
+    return pick, mask[np.arange(mask.shape[0]), pick]
+
+def balanceTransitionsMinus1_batch(trials, n, rng=None):
+    """Balance n-1 repetitions and switches in n sequences at once
+
+    as balanceTransitionsMinus1, but the n sequences are generated as the rows
+    of one array: all rows are permuted, scored and repaired together. Each
+    repair round swaps the middle elements of one pair of triplets in every
+    unbalanced row, changing its rep - sw by 4 (see the ReadMe). Rows that
+    cannot be repaired are drawn again all together, up to maxCounter times.
+
+    Parameters
+    ----------
+    trials: the lenght of the needed sequences (int)
+    n: the number of sequences (int)
+    rng: the np.random.Generator to draw from, or an int seed (optional)
+
+    Returns
+    -------
+    list
+        np.array of shape (n, trials); np.array with the number of repetitions
+        of each row; np.array with the number of switches of each row
+    """
+    rng = np.random.default_rng(rng)
+    maxCounter = 10
+    if type(trials) != int or type(n) != int:
+        raise ValueError("trials and n must be of type integer.")
+    if trials%2 != 0:
+        raise ValueError("trials argument must be an even integer.")
+    if trials <= 0 or n <= 0:
+        raise ValueError("trials and n must both be greater than 0.")
+    with track("balanceTransitionsMinus1_batch") as stats:
+        seqs = np.empty((n, trials), dtype=int)
+        todo = np.arange(n) # rows still to be generated
+        counter = 0
+        while todo.size and counter <= maxCounter:
+            # shuffle each row of a balanced block of 0s and 1s
+            with stats.phase("shuffle"):
+                perm = rng.random((todo.size, trials)).argsort(axis=1)
+                block = np.repeat([0, 1], trials//2)[perm]
+                rep, sw = transition_counts(block)
+            diff = rep - sw
+            stuck = np.zeros(todo.size, dtype=bool)
+            with stats.phase("repair"):
+                while True:
+                    rows = np.flatnonzero((np.abs(diff) > 1) & ~stuck)
+                    if not rows.size:
+                        break
+                    sub = block[rows]
+                    mid = sub[:, 1:-1] # middle elements of all the triplets
+                    # number of neighbours equal to the middle element: 2 for 000 or
+                    # 111, 0 for 010 or 101, 1 for 001, 100, 011 and 110
+                    same = (sub[:, :-2] == mid).astype(int) + (sub[:, 2:] == mid)
+                    moreRep = diff[rows] > 1
+                    # first triplet: 000 or 111 if more rep, 010 or 101 if more sw
+                    first, found1 = _pick_true(same == np.where(moreRep, 2, 0)[:, None], rng)
+                    firstVal = mid[np.arange(rows.size), first]
+                    # second triplet: 001, 100, 011 or 110 with the other middle
+                    # element, not overlapping the first one
+                    dist = np.abs(np.arange(trials-2) - first[:, None])
+                    second, found2 = _pick_true((same == 1) & (mid != firstVal[:, None]) & (dist >= 2), rng)
+                    found = found1 & found2
+                    stats.add("swaps_tried", rows.size)
+                    stats.add("swaps_accepted", int(found.sum()))
+                    stuck[rows[~found]] = True
+                    r = rows[found]
+                    i = first[found] + 1
+                    j = second[found] + 1
+                    block[r, i], block[r, j] = block[r, j], block[r, i] #swap middle elements of the 2 triplets
+                    diff[r] -= np.where(moreRep[found], 4, -4)
+            # keep the balanced rows, the others are drawn again as a group
+            ok = np.abs(diff) == 1
+            seqs[todo[ok]] = block[ok]
+            todo = todo[~ok]
+            counter += 1
+        stats["retries"] = counter - 1
+        if todo.size:
+            raise Warning("N - 1 transitions couldn't be balanced in " + str(todo.size) + " sequences by balanceTransitionsMinus1_batch function")
+        #these redudnant tests check integrity of the sequences after the manipulations
+        with stats.phase("check"):
+            if not all(count_labels(seqs, 2)[:, 0] == trials//2):
+                raise Warning("number of 0s is different from number of 1s")
+            rep, sw = transition_counts(seqs)
+            if not all(np.abs(rep - sw) == 1):
+                raise Warning("N - 1 transitions couldn't be balanced by balanceTransitionsMinus1_batch function")
+    return [seqs, rep, sw]
+
+# seqs = balanceTransitionsMinus1_batch(96, 5000)[0]
+# print("perfomance N-1 batch of 5k: " + str(timeit.timeit(stmt= "balanceTransitionsMinus1_batch(96, 5000)", number=10, setup="from __main__ import balanceTransitionsMinus1_batch")/10))
+
+def balanceTransitionsMinus2(trials, rng=None):
+    rng = np.random.default_rng(rng)
     maxCounter =  10
     if type(trials) != int or type(maxCounter) != int:
         raise ValueError("trials and maxCounter must be of type integer.")
@@ -324,7 +459,7 @@ def balanceTransitionsMinus2(trials):
     seq_Completed = 0
     counter = 0
     while seq_Completed == 0 and counter <= maxCounter:
-        seqAndDiff = balanceTransitionsMinus1(trials)
+        seqAndDiff = balanceTransitionsMinus1(trials, rng)
         seq = seqAndDiff[0]
         diff = seqAndDiff[1]-seqAndDiff[2]
         change = 0
@@ -364,40 +499,18 @@ def balanceTransitionsMinus2(trials):
                 return seq
         # these redundant tests are to test integrity of the sequence after the manipulations
         counter += 1
-        zeross = 0
-        oness = 0
-        for i in range(trials):
-            if seq[i] == 0:
-                zeross +=1
-            else:
-                oness +=1
+        zeross, oness = count_labels(seq, 2)
         if zeross != oness:
             raise Warning("number of 0s is different from number of 1s")
-        rep=0
-        sw=0
-        for i in range(1, trials):
-            if seq[i] == seq[i-1]:
-                rep +=1
-            else:
-                sw +=1
         #alternate the first and second half of the sequence as a "zipper" to generate a balanced n-2 seq
-        seq_zipped = ["null"]*trials
-        for i in range(0, int(trials/2)):
-            seq_zipped[i * 2] = seq[i]
-        for i in range(0, int(trials/2)):
-            seq_zipped[i * 2 + 1] = seq[i+int(trials/2)]
+        seq_zipped = np.empty(trials, dtype=seq.dtype)
+        seq_zipped[0::2] = seq[:int(trials/2)]
+        seq_zipped[1::2] = seq[int(trials/2):]
         #test the final sequence balance in rep and sw
-        rep=0
-        sw=0
-        for i in range(2, trials):
-            if seq_zipped[i] == seq_zipped[i-2]:
-                rep +=1
-            else:
-                sw +=1
+        rep, sw = transition_counts(seq_zipped, lag=2)
         if abs(rep-sw) == 0:
             seq_Completed = 1 #Exit loop
     #if everything went well
-    seq_zipped = np.array(seq_zipped)
     return seq_zipped
 
 # test for balanceTransitionsMinus1, balanceTransitionsMinus1_str and balanceTransitionsMinus2
@@ -451,7 +564,7 @@ def balanceTransitionsMinus2(trials):
 #     print("the sequence is not balanced in its n-2 transitions. The diff betw sw and rep is different from 0")
 #
 
-def orderStimWithinTasks(trials, stimElmns, minusWhat = 1):
+def orderStimWithinTasks(trials, stimElmns, minusWhat = 1, rng = None):
     """Assign stimuli to taks in balanced fashion
 
     Generates a 2-columns array, with column 1 containing the output of a
@@ -471,12 +584,16 @@ def orderStimWithinTasks(trials, stimElmns, minusWhat = 1):
     trials: the lenght of the needed sequence (int)
     stimElmns: list with the elements of the second column
     minusWhat: either 1 for balanceTransitionsMinus1 or 2.
+    rng: np.random.Generator, optional
+        source of all the random draws; an int seed is also accepted and a
+        fresh Generator is used if None
 
     Returns
     -------
     np.array
         2 columns array with trials rows
     """
+    rng = np.random.default_rng(rng)
     if (trials/2)%len(stimElmns) != 0:
             raise ValueError("stimElmns list length must be a divisor of trials/2, otherwise balancing is not possible by construction. Also, trials must even integer")
     maxCounter = 10
@@ -484,16 +601,16 @@ def orderStimWithinTasks(trials, stimElmns, minusWhat = 1):
     counter = 0
     while seqCompleted == 0 and counter <= maxCounter:
         if minusWhat == 1:
-            taskSeq = balanceTransitionsMinus1(trials)[0]
+            taskSeq = balanceTransitionsMinus1(trials, rng)[0]
         elif minusWhat == 2:
-            taskSeq = balanceTransitionsMinus2(trials)
+            taskSeq = balanceTransitionsMinus2(trials, rng)
         else:
             raise ValueError("minusWhat must be either 1, if you want to balance n-1 rep and sw, or 2, if you want to balance n-2 rep and sw")
         stimAndTask = np.c_[taskSeq, np.zeros(trials)] # prepare an array trials*2 where the first column is trialSeq
         timesXtrial = trials/len(stimElmns)/2 # calculate how many times each stim stands with each of the 2 tasks
         stimLst = np.repeat(stimElmns,timesXtrial) # replicate the list with unique stimuli this number of times
         for task in range(2): # for task 0 and 1, create a vector of randomized stimuli
-            stimSeq = np.random.permutation(stimLst)
+            stimSeq = rng.permutation(stimLst)
             currTask = np.where(taskSeq == task)[0]
             currPos = 0
             for g in currTask: # paste one randomize vector aside tasks 0s and the other aside 1s
@@ -523,28 +640,135 @@ def orderStimWithinTasks(trials, stimElmns, minusWhat = 1):
                     raise Warning("the numbers cannot be correctly assigned to the 0s and the 1s. There are 1 (or more) pairs of 2 equal numbers in subsequent positions")
         # test for numbers assignment
         counter += 1
-        vec = [[0]*int(trials/2), [0]*int(trials/2)] # preallocate an array: trials/2 is the max lenght allowed for stimElmn list
         for task in range(2):
-            for i in stimElmns: # fill in the array with the times each element is found aside 0 and 1
-                vec[task][i] = sum(np.logical_and(stimAndTask[:,1] == i,stimAndTask[:,0] == task))
-            vec1 = [vec[task][i] for i in stimElmns] # take only the relevant positions of vec (some will be 0)
-            equalTimes = all(x== vec1[0] for x in vec1) # are number of time all the same within a task?
+            # the times each element is found aside 0 and 1
+            vec1 = np.unique(stimAndTask[stimAndTask[:,0] == task, 1], return_counts=True)[1]
+            equalTimes = len(vec1) == len(stimElmns) and all(vec1 == vec1[0]) # are number of time all the same within a task?
             if (not equalTimes) and counter > maxCounter:
                 raise Warning("the function is wrong: stimuli are not equally represented in task " + str(task))
         # test for effectiveness of the removal of numbers repetitions
-        bool_2inARow = [stimAndTask[i, 1] == stimAndTask[i-1, 1] for i in range(1,trials)]
-        if (any(bool_2inARow)) and counter > maxCounter:
+        bool_2inARow = transition_counts(stimAndTask[:, 1])[0] > 0
+        if bool_2inARow and counter > maxCounter:
             raise Warning("2 equal stimuli are found in subsequent positions")
         # test for integrity of trialSeq after manipulations
         if not all(taskSeq == stimAndTask[:,0]):
             raise Warning("the final sequence of tasks (0 and 1) is not identical to the starting one. The function should not cause the sequence to change")
         # assign 1 to seqCompleted variable to exit the while loop
-        if (not any(bool_2inARow)) and equalTimes:
+        if (not bool_2inARow) and equalTimes:
             seqCompleted = 1
     #return [stimAndTask, taskSeq, counter]
     return stimAndTask
 
-def orderStimWithinTasks_str(trials, stimElmns, Tasks, str = True, minusWhat = 1, percent_rep = 0.5, ready_taskSeq = []):
+def _assign_stim(taskIdx, nTasks, nStim, rng):
+    """stimulus codes balanced within tasks and without n-1 repetitions
+
+    Each task gets its own permutation of the stimuli, scattered at once on
+    the positions of that task. The n-1 repetitions are then removed by
+    local_search, swapping stimuli only between positions of the same task.
+    With 2 stimuli, which must alternate, one of the 2 alternations is drawn
+    if the task sequence allows it (see two_stim_feasible).
+    Returns None if a repetition cannot be removed.
+    """
+    trials = len(taskIdx)
+    if nStim == 2:
+        if not two_stim_feasible(taskIdx, nTasks):
+            return None
+        return ((np.arange(trials) + rng.integers(2)) % 2).astype(np.int32)
+    # positions of each task, one row per task
+    taskPos = np.argsort(taskIdx, kind="stable").reshape(nTasks, -1)
+    stimLst = np.repeat(np.arange(nStim, dtype=np.int32), taskPos.shape[1]//nStim)
+    stats = current()
+    with stats.phase("shuffle"):
+        stim = np.empty(trials, dtype=np.int32)
+        stim[taskPos] = rng.permuted(np.tile(stimLst, (nTasks, 1)), axis=1)
+    # swap stimuli within tasks until no n-1 repetition is left
+    with stats.phase("repair"):
+        stim, score, swaps = local_search(stim, [no_repeat(lag=1)], groups=taskIdx, rng=rng)
+    if score > 0:
+        return None
+    return stim
+
+def orderStimWithinTasks_codes(trials, stimElmns, Tasks, str = True, minusWhat = 1, percent_rep = 0.5, ready_taskSeq = [], rng = None):
+    """Assign stimuli to taks in balanced fashion, as integer codes
+
+    Same sequences as orderStimWithinTasks_str, without pandas: the tasks and
+    the stimuli are returned as codes together with their labels.
+
+    Parameters
+    ----------
+    see orderStimWithinTasks_str
+
+    Returns
+    -------
+    list
+        [codes, taskLabels, stimLabels]: codes is an int array of shape
+        (trials, 2) with the task codes in column 0 and the stimulus codes in
+        column 1; task i is taskLabels[i] and stimulus j is stimLabels[j]
+    """
+    rng = np.random.default_rng(rng)
+    if (trials/len(Tasks))%len(stimElmns) != 0:
+        raise ValueError("stimElmns list length must be a divisor of trials/number of tasks, otherwise balancing is not possible by construction. Also, trials must even integer")
+    if len(ready_taskSeq) != 0:
+        if len(np.unique(ready_taskSeq)) != len(Tasks):
+            raise ValueError("the list of Tasks names must be = len of unique elements in ready_taskSeq")
+        if len(ready_taskSeq) != trials:
+            raise ValueError("ready_taskSeq must contain trials elements.")
+    # cases no retry can solve (see feasibility.py)
+    if len(stimElmns) == 1 and trials > 1:
+        raise ValueError("a single stimulus would be repeated in every trial: stimElmns needs 2 elements or more.")
+    with track("orderStimWithinTasks_codes") as stats:
+        maxCounter = 20
+        if len(stimElmns) == 2:
+            # about 1.7/sqrt(trials) of the task sequences allow 2 stimuli
+            # (two_stim_feasible): draw task sequences until one does
+            maxCounter = int(20*math.sqrt(trials))
+        stim = None
+        counter = 0
+        while stim is None and counter <= maxCounter:
+            if len(ready_taskSeq) == 0: # if there's no taskSeq alreay, create one
+                with stats.phase("shuffle"):
+                    if percent_rep != 0.5: # if you don't want 50% switches, use this fun
+                        taskSeq = np.array(exact_repetition_proportion(trials, percent_rep, 0, 1, rng)[0])
+                    elif minusWhat == 1:
+                        taskSeq = balanceTransitionsMinus1(trials, rng)[0]
+                    elif minusWhat == 2:
+                        taskSeq = balanceTransitionsMinus2(trials, rng)
+                    else:
+                        raise ValueError("minusWhat must be either 1, if you want to balance n-1 rep and sw, or 2, if you want to balance n-2 rep and sw")
+            else:
+                taskSeq = np.asarray(ready_taskSeq)
+            # the tasks as codes 0, 1, ..., in the order of their sorted values
+            taskVals, taskIdx = np.unique(taskSeq, return_inverse=True)
+            taskIdx = taskIdx.astype(np.int32)
+            if len(set(count_labels(taskIdx, len(taskVals)))) != 1:
+                raise ValueError("each task must appear the same number of times in the task sequence.")
+            if len(stimElmns) == 2 and len(ready_taskSeq) != 0 and not two_stim_feasible(taskIdx, len(taskVals)):
+                # 2 stimuli must alternate: no assignment exists for this taskSeq
+                raise ValueError("with 2 stimuli, each task of ready_taskSeq needs as many trials in even as in odd positions.")
+            stim = _assign_stim(taskIdx, len(taskVals), len(stimElmns), rng)
+            counter += 1
+        stats["retries"] = counter - 1
+        if stim is None:
+            raise Warning("the numbers cannot be correctly assigned to the 0s and the 1s. There are 1 (or more) pairs of 2 equal numbers in subsequent positions")
+        with stats.phase("check"):
+            # test for numbers assignment: each stim as many times with each task
+            pairs = count_labels(taskIdx*len(stimElmns) + stim, len(taskVals)*len(stimElmns))
+            if not all(pairs == trials//len(taskVals)//len(stimElmns)):
+                raise Warning("the function is wrong: stimuli are not equally represented in each task")
+            # test for effectiveness of the removal of numbers repetitions
+            if transition_counts(stim)[0] > 0:
+                raise Warning("2 equal stimuli are found in subsequent positions")
+    # the labels of the codes: tasks names (or task values) and stim elements
+    if str:
+        taskLabels = np.array(Tasks, dtype=object)[taskVals]
+    else:
+        taskLabels = taskVals
+    stimLabels = np.asarray(stimElmns)
+    if stimLabels.dtype.kind not in "biuf": # keep str (or mixed) elements as they are
+        stimLabels = np.array(stimElmns, dtype=object)
+    return [np.c_[taskIdx, stim], taskLabels, stimLabels]
+
+def orderStimWithinTasks_str(trials, stimElmns, Tasks, str = True, minusWhat = 1, percent_rep = 0.5, ready_taskSeq = [], rng = None, encoding = None):
     """Assign stimuli to taks in balanced fashion
 
     as its _str-less version.
@@ -555,6 +779,9 @@ def orderStimWithinTasks_str(trials, stimElmns, Tasks, str = True, minusWhat = 1
     (b) elements do not repeat in subsequent rows and
     (c) each element will be equally often in rows where column1 = 0 and
     rows where column1 = 1.
+    Tasks and stimuli are handled as integer codes, replaced by Tasks and
+    stimElmns only when the dataframe is built (see
+    orderStimWithinTasks_codes for the codes without pandas).
 
     minusWhat parameter is 1 by default. You may want to substitute
     balanceTransitionsMinus2 function in the function with the ABC version and
@@ -569,100 +796,123 @@ def orderStimWithinTasks_str(trials, stimElmns, Tasks, str = True, minusWhat = 1
     minusWhat: either 1 for balanceTransitionsMinus1 or 2.
     percent_rep: how many switches in %?
     ready_taskSeq: (np.array) the task sequence if created outside the function
+    rng: np.random.Generator, optional
+        source of all the random draws; an int seed is also accepted and a
+        fresh Generator is used if None
+    encoding: str, optional
+        None for columns of task names and stimuli, "category" for
+        categorical columns or "codes" for the pair (df of int codes, dict of
+        the labels of each column)
 
     Returns
     -------
     pd.DataFrame
         2 columns df with trials rows
     """
-    if (trials/len(Tasks))%len(stimElmns) != 0:
-        raise ValueError("stimElmns list length must be a divisor of trials/number of tasks, otherwise balancing is not possible by construction. Also, trials must even integer")
-    maxCounter = 20
-    seqCompleted = 0
-    counter = 0
-    while seqCompleted == 0 and counter <= maxCounter:
-        if ready_taskSeq == []: # if there's no taskSeq alreay, create one
-            if percent_rep != 0.5: # if you don't want 50% switches, use this fun
-                taskSeq = np.array(exact_repetition_proportion(trials, percent_rep, 0, 1)[0])
-            if minusWhat == 1:
-                taskSeq = np.array(balanceTransitionsMinus1_str(trials, 0, 1)[0])
-            elif minusWhat == 2:
-                taskSeq = balanceTransitionsMinus2(trials)
-            else:
-                raise ValueError("minusWhat must be either 1, if you want to balance n-1 rep and sw, or 2, if you want to balance n-2 rep and sw")
-        else:
-            if len(np.unique(ready_taskSeq)) != len(Tasks):
-                raise ValueError("the list of Tasks names must be = len of unique elements in ready_taskSeq")
-            taskSeq = ready_taskSeq
-            #print(taskSeq)
-        stimAndTask = np.c_[taskSeq, np.zeros(trials)] # prepare an array trials*2 where the first column is trialSeq
-        stim2num = list(range(len(stimElmns)))
-        timesXtrial = trials/len(stimElmns)/len(Tasks) # calculate how many times each stim stands with each of the tasks
-        stimLst = np.repeat(stim2num,timesXtrial) # replicate the list with unique stimuli this number of times
-        for ttt in np.unique(taskSeq): # for all the tasks, create a vector of randomized stimuli
-            stimSeq = np.random.permutation(stimLst)
-            currTask = np.where(taskSeq == ttt)[0]
-            currPos = 0
-            for g in currTask: # paste one randomize vector aside tasks 0s and the other aside 1s
-                stimAndTask[g, 1] = stimSeq[currPos]
-                currPos += 1
-        for j in range(1, trials): # now the stim sequence is checked for stimuli (n-1) repetitions
-            if stimAndTask[j, 1] == stimAndTask[j-1, 1]: # if it's found, the first of the j-1,j pair is saved:
-                change = stimAndTask[j-1, 1] # which number is that repeats
-                itsTask = stimAndTask[j-1, 0] # to which task is it associated
-                # look for an adapt position, starts from 2 numbers after the j of the j-1,j pair of numbers:
-                # "i" goes from 2 to up to trials - 1, since you want to stop 2 positions before the starting point
-                for i in range(2, trials-1):
-                    found = [] # found is initially false
-                    # ind runs in a circle over the sequence
-                    ind = (j+i)%(trials-1) # I want ind to get to 94th position and to restart from 0 at the 95th
-                    cond1 = stimAndTask[ind-1, 1] != change # the number before should not be = change
-                    cond2 = stimAndTask[ind, 1] != change # the candidate number should not be = change
-                    cond3 = stimAndTask[ind+1, 1] != change # the following before should not be = change
-                    cond4 = stimAndTask[j-2, 1] != stimAndTask[ind, 1] # the found number should be different from the one before j-1
-                    condTask = stimAndTask[ind, 0] == itsTask # the task should be the same assigned to change
-                    if cond1 and cond2 and cond3 and cond4 and condTask:
-                        found = stimAndTask[ind, 1] # a suitable position has been found, swap change and found
-                        stimAndTask[ind, 1] = change # the position in the middle of the triplet takes value change
-                        stimAndTask[j-1, 1] = found # the position of the first element of the pair of equal numbers gets the value found
-                        break
-                if not found and counter == maxCounter:
-                    #print(stimAndTask)
-                    raise Warning("the numbers cannot be correctly assigned to the 0s and the 1s. There are 1 (or more) pairs of 2 equal numbers in subsequent positions")
-        # increase counter
-        counter += 1
-        # # test for numbers assignment
-        # if (len(stimElmns) != trials):
-        #     vec = [[0]*int(trials/2), [0]*int(trials/2)] # preallocate an array: trials/2 is the max lenght allowed for stimElmn list
-        #     for task in range(len(Tasks)):
-        #         for i in stim2num: # fill in the array with the times each element is found aside 0 and 1
-        #             vec[task][i] = sum(np.logical_and(stimAndTask[:,1] == i,stimAndTask[:,0] == task))
-        #         vec1 = [vec[task][i] for i in stim2num] # take only the relevant positions of vec (some will be 0)
-        #         equalTimes = all(x== vec1[0] for x in vec1) # are number of time all the same within a task?
-        #         if (not equalTimes) and counter > maxCounter:
-        #             raise Warning("the function is wrong: stimuli are not equally represented in task " + str(task))
-        # test for effectiveness of the removal of numbers repetitions
-        bool_2inARow = [stimAndTask[i, 1] == stimAndTask[i-1, 1] for i in range(1,trials)]
-        if (any(bool_2inARow)) and counter > maxCounter:
-            raise Warning("2 equal stimuli are found in subsequent positions")
-        # test for integrity of trialSeq after manipulations
-        if not all(taskSeq == stimAndTask[:,0]):
-            raise Warning("the final sequence of tasks (0 and 1) is not identical to the starting one. The function should not cause the sequence to change")
-        # assign 1 to seqCompleted variable to exit the while loop
-        if not any(bool_2inARow):
-            seqCompleted = 1
-            stimAndTask_df = pd.DataFrame(stimAndTask, columns = ['task', 'stimN'])
-            if str: # if string is true change tasks, otheriwse stim only
-                # substitute 1 and 0 with the task names
-                for ttt in np.unique(taskSeq):
-                    task0_indx = stimAndTask_df[stimAndTask_df['task'] == ttt].index
-                    stimAndTask_df.loc[task0_indx, 'task'] = Tasks[ttt]
-            # substitute numerical stim with stim elements
-            temp2stim = pd.DataFrame(list(zip(stimLst, stimElmns)), columns = ['stimN', 'stim'])
-            stimAndTask_df = stimAndTask_df.merge(temp2stim, how = "left").drop(["stimN"], axis = 1)
+    _check_encoding(encoding)
+    codes, taskLabels, stimLabels = orderStimWithinTasks_codes(trials, stimElmns, Tasks, str, minusWhat, percent_rep, ready_taskSeq, rng)
+    pd = _pandas()
+    if encoding is not None:
+        task, stim = _encode(codes[:, 0], taskLabels, encoding), _encode(codes[:, 1], stimLabels, encoding)
+        if encoding == "codes":
+            return (pd.DataFrame({"task": task[0], "stim": stim[0]}), {"task": task[1], "stim": stim[1]})
+        return pd.DataFrame({"task": task, "stim": stim})
+    stimAndTask_df = pd.DataFrame({"task": taskLabels[codes[:, 0]], "stim": stimLabels[codes[:, 1]]})
     #return [stimAndTask_df, taskSeq, counter]
     return stimAndTask_df
 
+def counterbalanceParticipants(nParticipants, trials, stimElmns, Tasks, rng=None):
+    """Task and stimulus sequences of many participants, counterbalanced
+
+    Each participant gets a sequence as orderStimWithinTasks_codes would give
+    (2 tasks with balanced n-1 transitions, stimuli without n-1 repetitions
+    and equally often with each task), and across participants every task,
+    stimulus and task-stimulus pair is equally often at each trial.
+    Only one base sequence is generated every 2*len(stimElmns) participants
+    (the task sequences all at once with balanceTransitionsMinus1_batch);
+    the participants of a base get its task and stimulus codes rotated as
+    in the rows of two Latin squares, which keeps every constraint of the
+    sequence and fills each trial with all the task-stimulus pairs.
+
+    Parameters
+    ----------
+    nParticipants: the number of participants (int); the counterbalancing
+        across participants is exact for multiples of 2*len(stimElmns)
+    trials: the lenght of the sequences (int)
+    stimElmns: list with the stimuli
+    Tasks: list with the 2 tasks names
+    rng: np.random.Generator, optional
+        source of all the random draws; an int seed is also accepted and a
+        fresh Generator is used if None
+
+    Returns
+    -------
+    list
+        [codes, taskLabels, stimLabels]: codes is an int array of shape
+        (nParticipants, trials, 2), of the smallest int type, with the task
+        codes of each participant in [:, :, 0] and the stimulus codes in
+        [:, :, 1]; task i is taskLabels[i] and stimulus j is stimLabels[j]
+    """
+    rng = np.random.default_rng(rng)
+    nTasks, nStim = len(Tasks), len(stimElmns)
+    if type(nParticipants) != int or nParticipants <= 0:
+        raise ValueError("nParticipants must be an integer greater than 0.")
+    if nTasks != 2:
+        raise ValueError("Tasks must contain 2 tasks names.")
+    if type(trials) != int or trials%(nTasks*nStim) != 0:
+        raise ValueError("stimElmns list length must be a divisor of trials/number of tasks, otherwise balancing is not possible by construction.")
+    if nStim == 1:
+        raise ValueError("a single stimulus would be repeated in every trial: stimElmns needs 2 elements or more.")
+    cycle = nTasks*nStim
+    nBase = -(-nParticipants // cycle)
+    with track("counterbalanceParticipants") as stats:
+        with stats.phase("shuffle"):
+            taskBase = balanceTransitionsMinus1_batch(trials, nBase, rng)[0]
+            stimBase = np.empty((nBase, trials), dtype=int)
+            retries = 0
+            # see orderStimWithinTasks_codes
+            maxCounter = int(20*math.sqrt(trials)) if nStim == 2 else 20
+            for k in range(nBase):
+                stim = None
+                counter = 0
+                while stim is None and counter <= maxCounter:
+                    if counter > 0:
+                        taskBase[k] = balanceTransitionsMinus1(trials, rng)[0]
+                    stim = _assign_stim(taskBase[k].astype(np.int32), nTasks, nStim, rng)
+                    counter += 1
+                retries += counter - 1
+                if stim is None:
+                    raise Warning("the stimuli cannot be assigned to the tasks without n-1 repetitions")
+                stimBase[k] = stim
+            stats["retries"] = retries
+            # participant p: base p // cycle, rows p % nTasks and
+            # (p // nTasks) % nStim of the Latin squares
+            p = np.arange(nParticipants)
+            base = p // cycle
+            codes = np.empty((nParticipants, trials, 2), dtype=np.min_scalar_type(max(nTasks, nStim)))
+            codes[:, :, 0] = (taskBase[base] + (p % nTasks)[:, None]) % nTasks
+            codes[:, :, 1] = (stimBase[base] + (p // nTasks % nStim)[:, None]) % nStim
+        with stats.phase("check"):
+            task, stim = codes[:, :, 0].astype(int), codes[:, :, 1]
+            if (transition_counts(stim)[0] > 0).any():
+                raise Warning("2 equal stimuli are found in subsequent positions")
+            pairs = count_labels(task*nStim + stim, cycle)
+            if not (pairs == trials//cycle).all():
+                raise Warning("the function is wrong: stimuli are not equally represented in each task")
+            full = nParticipants - nParticipants % cycle
+            if full > 0:
+                # each pair as often at each trial, across the complete cycles
+                perTrial = count_labels((task[:full]*nStim + stim[:full]).T, cycle)
+                if not (perTrial == full//cycle).all():
+                    raise Warning("the task-stimulus pairs are not counterbalanced across participants")
+    stimLabels = np.asarray(stimElmns)
+    if stimLabels.dtype.kind not in "biuf": # keep str (or mixed) elements as they are
+        stimLabels = np.array(stimElmns, dtype=object)
+    return [codes, np.array(Tasks, dtype=object), stimLabels]
+
+# codes, taskLabels, stimLabels = counterbalanceParticipants(480, 384, list(range(24)), ["a", "b"], rng=2020)
+# participant0 = taskLabels[codes[0, :, 0]], stimLabels[codes[0, :, 1]]
+
 # #  ------- test for orderStimWithinTasks performance and correctness --------
 # trials = 384
 # #stimLst = list(range(1,5)) + list(range(6,10))
@@ -736,11 +986,147 @@ def orderStimWithinTasks_str(trials, stimElmns, Tasks, str = True, minusWhat = 1
 #             if stimAndTask.loc[jj, "stim"] == stimAndTask.loc[jj-1, "stim"]:
 #                 print ("2 equal stimuli are found in subsequent positions in sim: " + str(sim))
 
-def noStimRepetition(trials, stimElmns = [1], stimLst = []):
+def _no_repeat_codes(counts, rng):
+    """sequence of codes 0..len(counts)-1 without n-1 repetitions
+
+    Code c appears counts[c] times. Each position draws one of the codes
+    still available, other than the previous one, with probability
+    proportional to how many times it is still needed. When what is left
+    would become impossible to order, i.e. when a code is needed in every
+    other remaining position, that code is taken. The draws use a Fenwick
+    tree of the counts, so the whole sequence costs O(trials * log(codes)).
+    """
+    return next(_iter_no_repeat_codes(counts, rng, sum(counts)), np.zeros(0, dtype=int))
+
+def _iter_no_repeat_codes(counts, rng, chunk):
+    """as _no_repeat_codes, yielding the sequence in pieces of chunk codes"""
+    counts = [int(c) for c in counts]
+    nCodes = len(counts)
+    left = sum(counts)
+    if max(counts) > (left+1)//2:
+        raise ValueError("the elements cannot be ordered without n-1 repetitions: one of them is more than half of the sequence.")
+    # Fenwick tree: tree[i] holds the sum of counts over a range ending at i-1
+    tree = [0]*(nCodes+1)
+    for c in range(nCodes):
+        i = c+1
+        while i <= nCodes:
+            tree[i] += counts[c]
+            i += i & -i
+    step = 1
+    while step*2 <= nCodes:
+        step *= 2
+    # codes grouped by how many times they are still needed
+    byCount = {}
+    for c in range(nCodes):
+        byCount.setdefault(counts[c], set()).add(c)
+    maxCount = max(counts)
+    prev = -1
+    t = chunk
+    while left:
+        if t == chunk:
+            seq = np.empty(min(chunk, left), dtype=int)
+            draws = rng.random(len(seq))
+            t = 0
+        while not byCount.get(maxCount):
+            maxCount -= 1
+        if left%2 == 1 and maxCount == (left+1)//2:
+            # that code must take this position and every other one after it
+            code = next(iter(byCount[maxCount]))
+        else:
+            # draw among the codes but prev, skipping prev's share of the total
+            prevCount = counts[prev] if prev >= 0 else 0
+            u = int(draws[t]*(left - prevCount))
+            if prev >= 0:
+                before = 0
+                i = prev
+                while i > 0:
+                    before += tree[i]
+                    i -= i & -i
+                if u >= before:
+                    u += prevCount
+            # smallest code whose cumulated count exceeds u
+            code = 0
+            k = step
+            while k:
+                if code+k <= nCodes and tree[code+k] <= u:
+                    code += k
+                    u -= tree[code]
+                k //= 2
+        seq[t] = code
+        byCount[counts[code]].discard(code)
+        counts[code] -= 1
+        byCount.setdefault(counts[code], set()).add(code)
+        i = code+1
+        while i <= nCodes:
+            tree[i] -= 1
+            i += i & -i
+        left -= 1
+        prev = code
+        t += 1
+        if t == len(seq):
+            yield seq
+
+def noStimRepetition_codes(trials, stimElmns = [1], stimLst = [], rng = None):
+    """sequence of integer codes that don't repeat in a row
+
+    Same sequences as noStimRepetition, without pandas: element i of the
+    sequence is labels[codes[i]].
+
+    Parameters
+    ----------
+    see noStimRepetition
+
+    Returns
+    -------
+    list
+        [codes, labels]: codes is an int array of length trials, labels the
+        sorted elements of stimLst if given, else the elements of stimElmns
+        (an object array if any of them is a str), each once: an element
+        listed k times in stimElmns appears k*trials/len(stimElmns) times
+    """
+    rng = np.random.default_rng(rng)
+
+    if (trials)%len(stimElmns) != 0:
+            raise ValueError("stimElmns list length must be a divisor of trials, otherwise balancing is not possible by construction. Also, trials must even integer")
+    userLst = len(stimLst) > 0 # was a complete list given by the user?
+    if userLst:
+        if len(stimLst) != trials:
+            raise ValueError("stimLst must contain trials elements.")
+        labels, counts = np.unique(stimLst, return_counts=True)
+    else: # generate the counts based on stimElmns & trials
+        timesXstim = trials//len(stimElmns) # calculate how many times each stim appears
+        # an element listed more than once is one label, as often as its copies
+        merged = {}
+        for i in stimElmns:
+            merged[i] = merged.get(i, 0) + timesXstim
+        if any(isinstance(i, str) for i in merged):
+            labels = np.array(list(merged), dtype=object)
+        else:
+            labels = np.array(list(merged))
+        counts = list(merged.values())
+    with track("noStimRepetition_codes") as stats:
+        with stats.phase("shuffle"):
+            codes = _no_repeat_codes(counts, rng)
+        with stats.phase("check"):
+            # test for numbers assignment, only run the test if a stimLst is not given
+            if not userLst:
+                vec1 = count_labels(codes, len(labels)) # the times each element is found
+                if not all(vec1 == counts): # as many times as listed in stimElmns?
+                    raise Warning("the function is wrong: stimuli are not equally represented")
+            # test for effectiveness of the removal of numbers repetitions
+            if transition_counts(codes)[0] > 0:
+                raise Warning("2 equal stimuli are found in subsequent positions")
+    return [codes, labels]
+
+def noStimRepetition(trials, stimElmns = [1], stimLst = [], rng = None, encoding = None):
     """sequence of integers that don't repeat in a row
 
     Generates a sequence of length trials without n minus 1 repetitions
     At the moment stimElmns CAN BE STR, stimLst MUST BE INT
+    The sequence is built position by position and never needs to be
+    adjusted or re-started: it only fails, immediately, when an element is
+    more than half of the sequence (ValueError). See noStimRepetition_codes
+    for the codes and their labels without pandas.
 
     Parameters
     ----------
@@ -749,6 +1135,12 @@ def noStimRepetition(trials, stimElmns = [1], stimLst = []):
         with the unique elements of the sequence (int or str)
     stimLst: list, optional
         a user-defined complete list of int of lenght = trials
+    rng: np.random.Generator, optional
+        source of all the random draws; an int seed is also accepted and a
+        fresh Generator is used if None
+    encoding: str, optional
+        None for the output below, "category" for a categorical pd.Series or
+        "codes" for the pair (int codes, array of the elements)
 
     Returns
     -------
@@ -757,73 +1149,26 @@ def noStimRepetition(trials, stimElmns = [1], stimLst = []):
         repeated trials/len(stimElmns) times or with stimLst
         elements
     """
-
-    if (trials)%len(stimElmns) != 0:
-            raise ValueError("stimElmns list length must be a divisor of trials, otherwise balancing is not possible by construction. Also, trials must even integer")
-    maxCounter = 10
-    seqCompleted = 0
-    counter = 0
-    while seqCompleted == 0 and counter <= maxCounter:
-        #stimAndTask = np.zeros(trials) # prepare a vec
-        if not stimLst: # if stimList is empty, generate it based on stimElmns & trials
-            timesXstim = trials/len(stimElmns) # calculate how many times each stim appears
-            # if there are str you need transformation to use np array in the fun
-            if any(isinstance(i, str) for i in stimElmns):
-                # transform stimElmns in int and repeat it timesXstim times
-                stimLst = np.repeat(list(range(len(stimElmns))), timesXstim)
-            else: # integer stimElmns doesnot require transfor., only repeat it
-                stimLst = np.repeat(stimElmns,timesXstim) # replicate the list with unique stimuli this number of times
-        stimSeq = np.random.permutation(stimLst) # randomize the list
-        for j in range(1, trials): # now the stim sequence is checked for stimuli (n-1) repetitions
-            if stimSeq[j] == stimSeq[j-1]: # if it's found, the first of the j-1,j pair is saved:
-                change = stimSeq[j-1] # which number is that repeats
-                # look for an adapt position, starts from 2 numbers after the j of the j-1,j pair of numbers:
-                # "i" goes from 2 to up to trials - 1, since you want to stop 2 positions before the starting point
-                for i in range(2, trials-1):
-                    found = [] # found is initially false
-                    # ind runs in a circle over the sequence
-                    ind = (j+i)%(trials-1) # I want ind to get to 94th position and to restart from 0 at the 95th (assuming 96 trials)
-                    cond1 = stimSeq[ind-1] != change # the number before should not be = change
-                    cond2 = stimSeq[ind] != change # the candidate number should not be = change
-                    cond3 = stimSeq[ind+1] != change # the following before should not be = change
-                    cond4 = stimSeq[ind] != stimSeq[j-2]# the candidate number should not be = the one before change
-                    if cond1 and cond2 and cond3 and cond4:
-                        found = stimSeq[ind] # a suitable position has been found, swap change and found
-                        stimSeq[ind] = change # the position in the middle of the triplet takes value change
-                        stimSeq[j-1] = found # the position of the first element of the pair of equal numbers gets the value found
-                        break
-                if not found and counter == maxCounter:
-                    raise Warning("the numbers cannot be correctly ordered. There are 1 (or more) pairs of 2 equal numbers in subsequent positions")
-        # increase counter
-        counter += 1
-        # test for numbers assignment, only run the test if a stimLst is not given
-        #if not stimLst:
-        if stimLst == []:
-            vec = [0]*trials # preallocate an array: trials is the max lenght allowed for stimElmn list
-            for i in stimLst: # fill in the array with the times each element is found
-                vec[i] = sum(stimSeq == i)
-            vec1 = [vec[i] for i in stimLst] # take only the relevant positions of vec (some will be 0)
-            equalTimes = all(x == vec1[0] for x in vec1) # are number of times all the same?
-            if (not equalTimes) and counter > maxCounter:
-                raise Warning("the function is wrong: stimuli are not equally represented")
-        # test for effectiveness of the removal of numbers repetitions
-        bool_2inARow = [stimSeq[i] == stimSeq[i-1] for i in range(1,trials)]
-        if (any(bool_2inARow)) and counter > maxCounter:
-            raise Warning("2 equal stimuli are found in subsequent positions")
-        if (not any(bool_2inARow)):
-            seqCompleted = 1
-    # when the seq is ready, change the int back into str or return the int seq
-    if any(isinstance(i, str) for i in stimElmns): # if you need pd.Series
+    _check_encoding(encoding)
+    codes, labels = noStimRepetition_codes(trials, stimElmns, stimLst, rng)
+    if len(stimLst) > 0 and any(isinstance(i, str) for i in stimElmns):
+        # the int of stimLst are the positions in stimElmns
+        labels = np.array(stimElmns, dtype=object)[labels]
+    if encoding == "category":
+        return _pandas().Series(_encode(codes, labels, encoding))
+    if encoding == "codes":
+        return _encode(codes, labels, encoding)
+    if labels.dtype == object: # if you need pd.Series
         # substitute numerical stim with stim elements
-        stimSeq_series = pd.Series(stimSeq) # create a series to host string elements
-        for s in stimLst:
-            s_indx = stimSeq_series[stimSeq_series == s].index
-            stimSeq_series.loc[s_indx] = stimElmns[s]
-        #return [stimSeq_series, counter]
+        stimSeq_series = _pandas().Series(labels[codes])
         return stimSeq_series
     else:
-        return stimSeq
-        #return [stimSeq, counter]
+        return labels[codes]
+
+# # regression test: an element listed twice is one label, never in a row
+# for seed in range(200):
+#     seq = noStimRepetition(32, ["a", "a", "b", "c"], rng=seed).to_numpy()
+#     assert (seq == "a").sum() == 16 and not (seq[1:] == seq[:-1]).any()
 
 
 # #test for effectiveness of the removal of numbers repetitions
@@ -869,7 +1214,15 @@ def noStimRepetition(trials, stimElmns = [1], stimLst = []):
 #      )
 
 
-def shuffle_rows(res, df2shuf, targetCol):
+def _occurrence(codes, n_codes):
+    """how many times each element of codes was already found before it"""
+    order = np.argsort(codes, kind="stable")
+    start = np.r_[0, np.cumsum(np.bincount(codes, minlength=n_codes))]
+    kth = np.empty(len(codes), dtype=int)
+    kth[order] = np.arange(len(codes)) - start[codes[order]]
+    return kth
+
+def shuffle_rows(res, df2shuf, targetCol, rng=None):
     """merge back a column in the dataframe
 
     Take the pseudorandomized stimuli or task sequence and re-order the rows of
@@ -881,30 +1234,33 @@ def shuffle_rows(res, df2shuf, targetCol):
     res: the one-column array resulting from the pseudorandomization
     df2shuf: the df to re-order
     targetCol: a string indicating the name of the column to merge back
+    rng: the np.random.Generator to draw from, or an int seed (optional)
 
     Returns
     -------
     DataFrame
         identical to df2shuf, but in different order.
     """
+    rng = np.random.default_rng(rng)
     # shuffle the dataframe rows to make the final df look more random
-    df2shuf = df2shuf.sample(frac=1).reset_index(drop=True)
-    # create an empty dataframe that will be output
-    df_output = pd.DataFrame(columns = df2shuf.columns)
-    # loop over the df2shuf rows to check for a match with ith elemnt of res
-    for i in range(len(res)):
-        # pick the firt match, thanks to the intial shuffle this still gives
-        # a ranomd-enough final df
-        #print(i)
-        #print(res[i])
-        ch = df2shuf[df2shuf[targetCol]== res[i]].index[0]
-        row = df2shuf.iloc[ch] # create a new row as the matching row
-        df_output = df_output.append(row, ignore_index = True) # append the new row
-        df2shuf = df2shuf.drop([ch], axis =0) # drop the macthing row from the df2shuf
-        df2shuf.reset_index(inplace = True, drop= True) # reset index
+    perm = rng.permutation(len(df2shuf))
+    # the same integer code for equal values in targetCol and in res
+    codes, uniques = _pandas().factorize(np.concatenate([df2shuf[targetCol].to_numpy()[perm], np.asarray(res)]))
+    dfCodes = codes[:len(perm)]
+    resCodes = codes[len(perm):]
+    # one queue of (shuffled) row positions per value, all queues laid one
+    # after the other: value v has its rows in queues[start[v]:start[v+1]]
+    queues = perm[np.argsort(dfCodes, kind="stable")]
+    sizes = np.bincount(dfCodes, minlength=len(uniques))
+    start = np.r_[0, np.cumsum(sizes)]
+    # the kth time a value is found in res, it takes the kth row of its queue
+    kth = _occurrence(resCodes, len(uniques))
+    if (kth >= sizes[resCodes]).any():
+        raise ValueError("res has more elements of a certain value than the rows of df2shuf having that value in " + str(targetCol))
+    df_output = df2shuf.take(queues[start[resCodes] + kth]).reset_index(drop=True)
     return df_output
 
-def DfBooleanOrder(df2shuf, targetCol, stimSeq, taskCol, taskSeq):
+def DfBooleanOrder(df2shuf, targetCol, stimSeq, taskCol, taskSeq, rng=None):
     """merge 2 columns back in the dataframe
 
     Take the pseudorandomized stimuli AND task sequence and re-order the rows of
@@ -922,23 +1278,52 @@ def DfBooleanOrder(df2shuf, targetCol, stimSeq, taskCol, taskSeq):
         as the taskSeq array
     taskSeq: the one-column array resulting from the pseudorandomization that
         matches the values in taskCol
+    rng: the np.random.Generator to draw from, or an int seed (optional)
 
     Returns
     -------
     DataFrame
         identical to df2shuf, but in different order.
     """
+    return DfOrder(df2shuf, [(targetCol, stimSeq), (taskCol, taskSeq)], rng)
+
+def DfOrder(df2shuf, colSeqs, rng=None):
+    """merge any number of columns back in the dataframe
+
+    as DfBooleanOrder, but for as many pseudorandomized columns as needed:
+    each row of the output matches, in every given column, the corresponding
+    element of that column's sequence.
+    E.g. DfOrder(trialSeq, [("stim", stimSeq), ("task", taskSeq), ("colour", colourSeq)])
+
+    Parameters
+    ----------
+    df2shuf: the df to re-order
+    colSeqs: list of (column name, sequence) pairs, or a dict with column names
+        as keys; all the sequences must have the same length
+    rng: the np.random.Generator to draw from, or an int seed (optional)
+
+    Returns
+    -------
+    DataFrame
+        identical to df2shuf, but in different order.
+    """
+    rng = np.random.default_rng(rng)
+    colSeqs = list(dict(colSeqs).items())
+    cols = [col for col, seq in colSeqs]
     # shuffle the dataframe rows to make the final df look more random
-    df2shuf = df2shuf.sample(frac=1).reset_index(drop=True)
-    # create an empty dataframe that will be output
-    df_output = pd.DataFrame(columns = df2shuf.columns)
-    for i in range(len(stimSeq)):
-        boolean_condition = (df2shuf[taskCol] == taskSeq[i]) & (df2shuf[targetCol] == stimSeq[i])
-        ch = df2shuf.loc[boolean_condition].index[0]
-        row = df2shuf.iloc[ch]
-        df_output = df_output.append(row, ignore_index = True)
-        df2shuf = df2shuf.drop([ch], axis =0)
-        df2shuf.reset_index(inplace = True, drop= True)
+    df2shuf = df2shuf.sample(frac=1, random_state=rng).reset_index(drop=True)
+    # number the rows sharing the same values in cols, both in the wished
+    # sequences and in the shuffled df: the kth wished combination of values
+    # takes the kth matching row
+    wanted = _pandas().DataFrame({col: np.asarray(seq) for col, seq in colSeqs})
+    wanted["kth_"] = wanted.groupby(cols, sort=False, dropna=False).cumcount()
+    available = df2shuf[cols].copy()
+    available["kth_"] = available.groupby(cols, sort=False, dropna=False).cumcount()
+    available["row_"] = np.arange(len(available))
+    matched = wanted.merge(available, on=cols + ["kth_"], how="left", sort=False)
+    if matched["row_"].isna().any():
+        raise ValueError("the sequences contain a combination of values more times than the rows of df2shuf having it in " + str(cols))
+    df_output = df2shuf.take(matched["row_"].to_numpy(dtype=int)).reset_index(drop=True)
     return df_output
 
 # # Test for DfBooleanOrder and shuffle_rows
@@ -982,12 +1367,149 @@ def DfBooleanOrder(df2shuf, targetCol, stimSeq, taskCol, taskSeq):
 # %timeit -r 10 DfBooleanOrder(df2shuf, targetCol, stimSeq, taskCol, taskSeq)
 
 
-def balanceNMinus2_str(trials, A, B, C):
+def _repair_nMinus2(seq, rng):
+    """balance n-2 rep and sw of a sequence without n-1 repetitions
+
+    Works on 6-tuples x0..x5 with x1 == x4: swapping x2 and x3 never creates
+    n-1 repetitions and only changes the n-2 transitions x0-x2 and x3-x5,
+    which become x0-x3 and x2-x5. Without n-1 repetitions x0 and x5 are
+    each x2 or x3, so the swap changes rep - sw by -4, 0 or +4. The 6-tuples
+    changing it by 4 are indexed once; after a swap only the 7 6-tuples
+    around it are checked again and rep - sw is updated without counting, so
+    each round costs O(1).
+    Swaps inside the sequence keep rep - sw the same modulo 4: when it is
+    off by 2, the first element is swapped with one surrounded by the
+    second element, which changes the number of n-2 repetitions by an odd
+    number. If no suitable swap is left, local_search finishes the job.
+    Returns None if it fails.
+    """
+    stats = current()
+    seq = np.asarray(seq).tolist()
+    n = len(seq)
+    rep, sw = transition_counts(seq, lag=2)
+    diff = rep - sw
+    # starts of the 6-tuples by the n-2 repetitions their swap removes (2)
+    # or adds (-2), as lists plus the index of each start in them
+    starts = {2: [], -2: []}
+    where = {2: {}, -2: {}}
+
+    def removed(a):
+        x0, x1, x2, x3, x4, x5 = seq[a:a+6]
+        if x1 != x4:
+            return 0
+        return (x0 == x2) + (x3 == x5) - (x0 == x3) - (x2 == x5)
+
+    def update(a):
+        k = removed(a)
+        for other in starts:
+            if other != k and a in where[other]:
+                # move the last start in the place of the removed one
+                i = where[other].pop(a)
+                last = starts[other].pop()
+                if last != a:
+                    starts[other][i] = last
+                    where[other][last] = i
+        if k != 0 and a not in where[k]:
+            where[k][a] = len(starts[k])
+            starts[k].append(a)
+
+    for a in range(n - 5):
+        update(a)
+    while abs(diff) > 1:
+        if diff % 4 == 2:
+            # x[j] is neither x[0] nor x[1] and its neighbours are x[1];
+            # j < n-2 so that x[j] has n-2 transitions on both sides
+            arr = np.array(seq)
+            mid = arr[2:n-2]
+            ok = (mid != arr[0]) & (mid != arr[1]) & (arr[1:n-3] == arr[1]) & (arr[3:n-1] == arr[1])
+            cand = np.flatnonzero(ok) + 2
+            if cand.size == 0:
+                break
+            j = int(cand[int(rng.random() * cand.size)])
+            seq[0], seq[j] = seq[j], seq[0]
+            stats.add("swaps_tried")
+            stats.add("swaps_accepted")
+            rep, sw = transition_counts(seq, lag=2)
+            diff = rep - sw
+            for b in {0} | set(range(max(0, j-5), min(n-5, j+1))):
+                update(b)
+            continue
+        k = 2 if diff > 0 else -2
+        if not starts[k]:
+            break
+        a = starts[k][int(rng.random() * len(starts[k]))]
+        seq[a+2], seq[a+3] = seq[a+3], seq[a+2]
+        diff -= 2*k
+        stats.add("swaps_tried")
+        stats.add("swaps_accepted")
+        for b in range(max(0, a-3), min(n-5, a+4)):
+            update(b)
+    if abs(diff) > 1:
+        seq, score, swaps = local_search(seq, [no_repeat(lag=1), balance(lag=2, tol=1)], rng=rng)
+        if score > 0:
+            return None
+    return np.array(seq)
+
+def balanceNMinus2_codes(trials, A, B, C, rng=None):
+    """balance n-2 repetitions and switch and avoid n-1 repetitions, as codes
+
+    Same sequences as balanceNMinus2_str, without pandas.
+
+    Parameters
+    ----------
+    see balanceNMinus2_str
+
+    Returns
+    -------
+    list
+        [codes, labels]: codes is an int array of 0, 1 and 2, labels the
+        object array [A, B, C]
+    """
+    rng = np.random.default_rng(rng)
+
+    if type(trials) != int:
+        raise ValueError("trials and maxCounter must be of type integer.")
+    if trials%2 != 0:
+        raise ValueError("trials argument must be an even integer.")
+    if trials <= 0:
+        raise ValueError("trials must both be greater than 0.")
+    if trials%3 != 0:
+        raise ValueError("trials must be a multiple of 3, so that A, B and C appear equally often.")
+    with track("balanceNMinus2_codes") as stats:
+        maxCounter = 4
+        seq = None
+        counter = 0
+        while seq is None and counter <= maxCounter:
+            # start without n-1 repetitions, then move tasks until n-2 rep and sw
+            # are balanced too
+            with stats.phase("shuffle"):
+                start = noStimRepetition_codes(trials, [0,1,2], rng = rng)[0]
+            with stats.phase("repair"):
+                seq = _repair_nMinus2(start, rng)
+            counter += 1
+        stats["retries"] = counter - 1
+        if seq is None:
+            raise Warning("N - 2 transitions couldn't be balanced by balanceNMinus2_str function")
+        #tests
+        with stats.phase("check"):
+            rep, sw = transition_counts(seq, lag=2)
+            post_diff = rep - sw
+            if abs(post_diff) > 1:
+                raise Warning("N - 2 repetitions and switches differ by " + str(post_diff))
+            nA, nB, nC = count_labels(seq, 3)
+            if not nA == nB == nC:
+                raise Warning("no same number of A, B and C" + str(nA) + " " + str(nB) + " " + str(nC))
+            if transition_counts(seq)[0] > 0:
+                raise Warning("there's a n-1 repetition")
+    return [seq, np.array([A, B, C], dtype=object)]
+
+def balanceNMinus2_str(trials, A, B, C, rng=None, encoding=None):
     """balance n-2 repetitions and switch and avoid n-1 repetitions
 
-    Generates a sequence of length trials of elements A,B and C with almost
-    balanced number of sw and repetitions (by now allows a delta of 3, it can
-    be restricted to 2 or 1 without the performance changing much)
+    Generates a sequence of length trials of elements A,B and C with
+    balanced number of n-2 sw and repetitions (a delta of at most 1, which
+    means equal numbers with an even number of trials) and without n-1
+    repetitions. See balanceNMinus2_codes for the sequence without pandas.
 
     Parameters
     ----------
@@ -997,6 +1519,12 @@ def balanceNMinus2_str(trials, A, B, C):
         name of task A, must be different from B and C
     B: str,
     C: str
+    rng: np.random.Generator, optional
+        source of all the random draws; an int seed is also accepted and a
+        fresh Generator is used if None
+    encoding: str, optional
+        None for a series of A, B and C, "category" for a categorical series
+        or "codes" for the pair (codes 0, 1 and 2, array [A, B, C])
 
     Returns
     -------
@@ -1004,85 +1532,15 @@ def balanceNMinus2_str(trials, A, B, C):
         dataframe with same number of A, B and C and almost balanced n-2
         repetitions and switches
     """
-
-    if type(trials) != int:
-        raise ValueError("trials and maxCounter must be of type integer.")
-    if trials%2 != 0:
-        raise ValueError("trials argument must be an even integer.")
-    if trials <= 0:
-        raise ValueError("trials must both be greater than 0.")
-    maxCounter =  1
-    seq_Completed = 0
-    counter = 0
-    while seq_Completed == 0 and counter <= maxCounter:
-        seq = noStimRepetition(trials, [0,1,2])[0]
-        rep=0
-        sw=0
-        for j in range(2, trials):
-            if seq[j] == seq[j-2]:
-                rep +=1
-            else:
-                sw +=1
-        diff = rep - sw
-        #print("this is diff " + str(diff))
-        # how big is the imbalance? Establish the number of rounds needed
-        Rounds = abs(diff)//4 + abs(diff)%4//3
-        for Round in range(Rounds):
-            #print("this is round " + str(Round))
-            swap = np.empty(1)
-            strt = randint(0, trials-1) # 0, 95
-            for i in range(trials-6): # 0, 89. It is ok (and possibly useful) if the ind gets as far as 3 positions before the strt
-                ind = (strt+i)%(trials-5)
-                if seq[ind+1] == seq[ind+4]:
-                    if diff > 0: # we have more repetitions
-                        cond1 = seq[ind] == seq[ind+2]
-                        cond2 = seq[ind+3] == seq[ind+5]
-                    elif diff < 0: # we have more switches
-                        cond1 = seq[ind] == seq[ind+3]
-                        cond2 = seq[ind+2] == seq[ind+5]
-                    if cond1 and cond2:
-                        #print("this is ind " + str(ind))
-                        #print("this are the 6 trials " + str(seq[ind:ind+6]))
-                        swap = seq[ind+2]
-                        seq[ind+2] = seq[ind+3]
-                        seq[ind+3] = swap
-                        #print("this are the 6 trials afterwards " + str(seq[ind:ind+6]))
-                        break
-            if not swap.size and counter == maxCounter: # Non capisco perche non mi stampa mai questo,
-                # anche quando dovrebbe
-                print("no 5-tuple could be found and rounds are over")
-        #tests
-        counter += 1
-        rep=0
-        sw=0
-        for i in range(2, trials):
-            if seq[i] == seq[i-2]:
-                rep +=1
-            else:
-                sw +=1
-        post_diff = rep - sw
-        nMinus2Balance = abs(post_diff) <= 2
-        #if not nMinus2Balance:
-            #print("we have a problem " + str(rep) + " " + str(sw))
-        ABCbalance = sum(seq == 0) == sum(seq == 1) == sum(seq == 2)
-        if not ABCbalance:
-            print("no same number of A, B and C" + str(sum(seq == 0)) + " " + str(sum(seq == 1)) + " " + str(sum(seq == 2)))
-        nMinus1Absence = 1
-        for i in range(1,trials):
-            if seq[i] == seq[i-1]:
-                print("there's a n-1 repetition")
-                nMinus1Absence = 0
-        if nMinus1Absence and ABCbalance and nMinus2Balance:
-            seq_Completed = 1
-            seq_df = pd.Series(seq)
-            taskA = seq_df[seq_df == 0].index
-            seq_df.loc[taskA] = A
-            taskB = seq_df[seq_df == 1].index
-            seq_df.loc[taskB] = B
-            taskC = seq_df[seq_df == 2].index
-            seq_df.loc[taskC] = C
-            #return [seq_df, post_diff, counter]
-            return seq_df
+    _check_encoding(encoding)
+    seq, labels = balanceNMinus2_codes(trials, A, B, C, rng)
+    if encoding == "codes":
+        return _encode(seq, labels, encoding)
+    if encoding == "category":
+        return _pandas().Series(_encode(seq, labels, encoding))
+    seq_df = _pandas().Series(labels[seq])
+    #return [seq_df, post_diff, counter]
+    return seq_df
 
 # nSim = 100
 # counterSim = 0
@@ -1099,95 +1557,120 @@ def balanceNMinus2_str(trials, A, B, C):
 # print "this is the number of times there was an error " + str(counterSim)
 # print "this is the history of counter in " + str(nSim) + " simulations: " + str(coun)
 
-import math
+def balanceNMinus2_exact(trials, A, B, C, tol=1, rng=None, encoding=None):
+    """balance n-2 repetitions and switch and avoid n-1 repetitions, exactly
 
-def exact_repetition_proportion(trials, percent_rep, task0, task1):
+    Same sequences as balanceNMinus2_str, but drawn uniformly among all the
+    valid ones with the counting tables of nminus2_tables.py: no retries
+    and no repairs. The first call for a given trials and tol builds the
+    table (and saves it to disk), the next ones only read it. The tables
+    grow as trials**4: above about 204 trials (nminus2_tables.MAX_TABLE_BYTES)
+    a ValueError is raised, use balanceNMinus2_str.
+
+    Parameters
+    ----------
+    trials: int
+        the lenght of the needed sequence, a multiple of 3
+    A: str,
+        name of task A, must be different from B and C
+    B: str,
+    C: str
+    tol: int
+        largest |n-2 repetitions - n-2 switches| allowed
+    rng: np.random.Generator, optional
+        source of all the random draws; an int seed is also accepted and a
+        fresh Generator is used if None
+    encoding: str, optional
+        see balanceNMinus2_str
+
+    Returns
+    -------
+    pd.Series
+        same number of A, B and C, no n-1 repetitions and n-2 repetitions
+        and switches differing by tol at most
+    """
+    rng = np.random.default_rng(rng)
+    _check_encoding(encoding)
+    with track("balanceNMinus2_exact") as stats:
+        with stats.phase("shuffle"):
+            seq = sample_nMinus2(trials, tol, rng)
+    labels = np.array([A, B, C], dtype=object)
+    if encoding == "codes":
+        return _encode(seq, labels, encoding)
+    if encoding == "category":
+        return _pandas().Series(_encode(seq, labels, encoding))
+    seq_df = _pandas().Series(labels[seq])
+    return seq_df
+
+# seq = balanceNMinus2_exact(96, "a", "b", "c", rng=2020)
+# print(transition_counts(seq.to_numpy(), lag=2))
+
+def exact_repetition_proportion(trials, percent_rep, task0, task1, rng=None, encoding=None):
     """ Generate sequence with certain proportion of repetitions
 
-    Generates a sequence of length trials of elements A and B with the porportion
-    of repetitions indicated by percent_rep. Max one rep more or one less than
-    the exact proportion
-    ! Currently, does not allow less than 50% repetitions !
+    Generates a sequence of length trials of elements A and B, each repeated
+    trials/2 times, with the porportion of repetitions indicated by
+    percent_rep: the sequence has exactly floor(trials*percent_rep)
+    repetitions. Any proportion from 0 (ABAB...) to 1 is allowed; since A and
+    B must both appear, at most trials-2 repetitions (AA...ABB...B) are
+    possible and higher targets are lowered to it.
+    As in balanceTransitionsMinus1, the sequence is built from its runs:
+    repetitions = trials - number of runs. Every sequence with the wanted
+    number of repetitions is equally likely.
 
     Parameters
     ----------
     trials: int
-        the lenght of the needed sequence
+        the lenght of the needed sequence, must be even
     percent_rep: float
-        proportion of rep over number of trials, must be between 0 and 1 excl.
+        proportion of rep over number of trials, between 0 and 1
     A: str,
         name of task A, must be different from B
     B: str,
         name of task B
+    rng: np.random.Generator, optional
+        source of all the random draws; an int seed is also accepted and a
+        fresh Generator is used if None
+    encoding: str, optional
+        see balanceTransitionsMinus1_str
 
     Returns
     -------
-    pd.DataFrame
-        dataframe with same number of A, B and C and almost balanced n-2
-        repetitions and switches
+    list
+        the sequence; the number of repetions; number of switches
     """
+    rng = np.random.default_rng(rng)
+    if type(trials) != int:
+        raise ValueError("trials must be of type integer.")
+    if trials%2 != 0 or trials <= 0:
+        raise ValueError("trials argument must be an even integer greater than 0.")
+    if not 0 <= percent_rep <= 1:
+        raise ValueError("percent_rep must be between 0 and 1.")
+    _check_encoding(encoding)
 
     # how many repetitions, rounded to closest lower integer
-    n_rep = math.floor(trials*percent_rep)
-
-    # create sequence with 50% rep and 50% switch
-    # seq len should be trials - abs(wnated_sw-wanted_repetitions)
-    init_seq_len = trials - abs(trials- n_rep - n_rep) # will always be even
-    # generate sequence with custom fnction
-    init_seq_out = balanceTransitionsMinus1_str(init_seq_len, task0, task1)
-    init_seq = init_seq_out[0]
-    # number of actual repetitions in the sequence
-    init_rep = init_seq_out[1]
-    # if n_rep < rep
-    # compute number of rep to add as difference between wanted repetitions and
-    # actual ones
-    rep = n_rep - init_rep
-    # round to the closest smaller even number
-    if rep%2 != 0:
-        rep = rep - 1
-
-    # create copy of initial seq
-    final_seq = [init_seq[i] for i in range(init_seq_len)]
-
-    # We add rep/2 repetitions to each task, to keep same number of task1 and 0
-    # create counters counter of added repetitions per task
-    ones = 0
-    zeros = 0
-    tasks = [task1, task0]
-    counters = [ones, zeros]
-
-    for r in range(2): # for task0 and 1
-        while counters[r] < rep/2: # while number of missing repetitions is not over
-            # draw a random position (trial) where task is either task0 or task1
-            i = random.choice([i for i in range(len(final_seq)) if final_seq[i] == tasks[r]])
-            final_seq.insert(i+1, final_seq[i]) # and make it into a repetition
-            counters[r] += 1 # increase counter
-
-    #these redudnant tests check integrity of the sequence after the manipulations
-    if len(final_seq) != trials:
-        raise Warning("number of trials is not" + str(trials) + " but " + str(len(final_seq)))
-
-    if final_seq.count(task0) !=  final_seq.count(task1):
-        #print("ciao")
-        raise Warning("number of " + str(task0) + "(" + str(zeross) + ") is different from number of " + str(task1) + "(" + str(oness) + ")")
-
-    reps=0
-    sws=0
-    for i in range(1, trials):
-        if final_seq[i] == final_seq[i-1]:
-            reps +=1
+    n_rep = min(math.floor(trials*percent_rep), trials-2)
+    with track("exact_repetition_proportion") as stats:
+        with stats.phase("shuffle"):
+            # each run but the first adds a switch
+            seq = _sample_runs(trials//2, trials//2, [trials - n_rep], rng)
+        if encoding is not None:
+            final_seq = _encode(seq, np.array([task0, task1], dtype=object), encoding)
         else:
-            sws += 1
-    if abs(n_rep-reps) > 1:
-        raise Warning("number of repetitions is " + str(reps) + " and is different from desired: " + str(n_rep))
-    # if correct number of rep and no warning was raised, return output
-    else:
-        print("success")
-        seq_Completed=1 # sequence is completed
-        #print(seq_Completed)
-        # retun seq and reps and sws
-        seqAndDiff = [final_seq, reps, sws]
-        return seqAndDiff
+            final_seq = np.array([task0, task1], dtype=object)[seq].tolist()
+
+        #these redudnant tests check integrity of the sequence
+        with stats.phase("check"):
+            zeross, oness = count_labels(seq, 2)
+            if zeross != oness:
+                raise Warning("number of " + str(task0) + "(" + str(zeross) + ") is different from number of " + str(task1) + "(" + str(oness) + ")")
+            runs = len(run_lengths(seq)[1])
+            reps, sws = trials - runs, runs - 1
+            if reps != n_rep:
+                raise Warning("number of repetitions is " + str(reps) + " and is different from desired: " + str(n_rep))
+    # retun seq and reps and sws
+    seqAndDiff = [final_seq, reps, sws]
+    return seqAndDiff
 
 # # output test:
 # # test the final sequence of exact_repetition_proportion
@@ -0,0 +1,222 @@
+"""Sessions of many blocks, generated in parallel and joined without seams.
+
+An experiment often runs as several blocks, each made by
+orderStimWithinTasks_str or balanceTransitionsMinus1_str. Glued one after
+the other, the blocks can repeat a stimulus across the seam (last trial of
+a block, first of the next one) and the seams add task repetitions or
+switches that unbalance the session. generate_session makes the blocks over
+a process pool (bulk_generate, one seed stream per block) and then fixes only
+the seams:
+
+    - the task names of each block are permuted (which keeps all the
+      constraints of the block, since every stimulus is as often with each
+      task) so that the seams bring the task repetitions of the session to
+      the proportion of the blocks (percent_rep of func, 0.5 by default),
+      e.g. |n-1 repetitions - n-1 switches| <= 1 for balanced blocks
+    - a stimulus repeated across a seam is swapped with a stimulus of the
+      same task elsewhere in the block, chosen so that no n-1 repetition is
+      created; in short blocks where no such swap exists, the repeated
+      stimulus and another one are exchanged in the whole block
+
+The result is one dataframe of the whole session in which every block
+still satisfies its own constraints. Only the generators of 2 tasks with a
+proportion of n-1 repetitions are accepted (SESSION_FUNCS): the seams of
+blocks without n-1 repetitions or with balanced n-2 transitions are not
+handled.
+
+This file can also be imported as a module and contains the following
+functions:
+
+    * generate_session
+"""
+
+import math
+import inspect
+import numpy as np
+import pandas as pd
+import funx_10
+from funx_bulk import bulk_generate
+from transition_stats import count_labels, transition_counts
+
+# the generators whose blocks the seams can join: 2 tasks with a proportion
+# of n-1 repetitions (no n-2 balance, no ban on repetitions)
+SESSION_FUNCS = (funx_10.orderStimWithinTasks_str, funx_10.balanceTransitionsMinus1_str,
+                 funx_10.balanceTransitionsMinus1, funx_10.exact_repetition_proportion)
+
+
+def _columns(out):
+    """the tasks and the stimuli (None if there are none) of one block"""
+    if isinstance(out, pd.DataFrame):
+        stim = out["stim"].to_numpy() if "stim" in out.columns else None
+        return np.asarray(out["task"].to_numpy()), stim
+    if isinstance(out, list):
+        # e.g. [seq, rep, sw]
+        out = out[0]
+    return np.asarray(out), None
+
+
+def _percent_rep(func, args, kwargs):
+    """the proportion of task repetitions func gives its blocks"""
+    try:
+        call = inspect.signature(func).bind(*args, **kwargs)
+    except (TypeError, ValueError):
+        return 0.5
+    call.apply_defaults()
+    return call.arguments.get("percent_rep", 0.5)
+
+
+def _seam_reps(blockReps, trials, nBlocks, percent_rep, rng):
+    """which seams must be task repetitions
+
+    As many as bring the repetitions of the session of trials trials to
+    floor(trials*percent_rep), as in exact_repetition_proportion, at random
+    seams.
+    """
+    seams = nBlocks - 1
+    wanted = min(math.floor(trials*percent_rep), trials - 2)
+    nReps = min(seams, max(0, wanted - blockReps))
+    isRep = np.zeros(seams, dtype=bool)
+    isRep[rng.choice(seams, nReps, replace=False)] = True
+    return isRep
+
+
+def _relabel(codes, nTasks, prev, rep, rng):
+    """random permutation of the task codes of a block such that its first
+    task is (rep) or is not prev"""
+    perm = rng.permutation(nTasks)
+    first = codes[0]
+    if rep and perm[first] != prev:
+        i = int(np.flatnonzero(perm == prev)[0])
+        perm[i], perm[first] = perm[first], perm[i]
+    elif not rep and perm[first] == prev:
+        i = (first + 1 + int(rng.integers(nTasks - 1))) % nTasks
+        perm[i], perm[first] = perm[first], perm[i]
+    return perm[codes]
+
+
+def _fix_start(task, stim, prev, rng):
+    """swap the first stimulus of a block with one of the same task so that
+    it differs from prev, the stimulus before the block
+
+    The last stimulus can change too: the next seam is checked afterwards.
+    Returns whether a swap was found; stim is changed in place.
+    """
+    s0 = stim[0]
+    j = np.arange(1, len(stim))
+    ok = (task[j] == task[0]) & (stim[j] != prev) & (stim[j] != s0)
+    # stim[j] moves to position 0, next to prev and stim[1]
+    ok &= (j == 1) | (stim[j] != stim[1])
+    # s0 moves to position j, next to stim[j-1] and stim[j+1]
+    ok &= (j == 1) | (stim[j - 1] != s0)
+    ok &= np.append(stim[2:] != s0, True)
+    if not ok.any():
+        return False
+    pick = j[ok][rng.integers(ok.sum())]
+    stim[0], stim[pick] = stim[pick], s0
+    return True
+
+
+def generate_session(func, nBlocks, *args, seed=None, workers=None, encoding=None, **kwargs):
+    """generate nBlocks blocks with func and join them into one session
+
+    e.g. generate_session(orderStimWithinTasks_str, 8, 96, stimuli, ["a", "b"], seed=2020)
+
+    Parameters
+    ----------
+    func: the function generating one block: orderStimWithinTasks_str
+        (dataframe with task and stim columns), balanceTransitionsMinus1_str,
+        balanceTransitionsMinus1 or exact_repetition_proportion (task
+        sequences); other generators raise ValueError
+    nBlocks: the number of blocks (int)
+    *args, **kwargs: the arguments of func, the same for every block
+    seed: int, optional
+        master seed, see bulk_generate; the same seed gives the same session
+    workers: int, optional
+        number of processes generating the blocks, see bulk_generate
+    encoding: str, optional
+        encoding of the task and stim columns of the session, as in
+        orderStimWithinTasks_str: None, "category" or "codes"; the blocks
+        are generated without it
+
+    Returns
+    -------
+    pd.DataFrame or tuple
+        one row per trial of the session: block, trial (within the block),
+        task and, if func gives them, stim; with encoding="codes" the pair
+        (dataframe with the codes of task and stim, dict with their labels)
+    """
+    if type(nBlocks) != int or nBlocks <= 0:
+        raise ValueError("nBlocks must be an integer greater than 0.")
+    funx_10._check_encoding(encoding)
+    if func not in SESSION_FUNCS:
+        # e.g. the seams would add n-1 repetitions to noStimRepetition blocks
+        # and unbalance the n-2 transitions of balanceNMinus2_str blocks
+        raise ValueError("func must be one of " + ", ".join(f.__name__ for f in SESSION_FUNCS) + ": the seams of other generators are not handled.")
+    outs = bulk_generate(func, nBlocks, *args, seed=seed, workers=workers, **kwargs)
+    # the seams get their own stream, after those of the blocks
+    rng = np.random.default_rng(np.random.SeedSequence(seed).spawn(nBlocks + 1)[-1] if seed is not None else None)
+    blocks = [_columns(out) for out in outs]
+    taskLabels, taskCodes = np.unique(np.concatenate([b[0] for b in blocks]), return_inverse=True)
+    lengths = [len(b[0]) for b in blocks]
+    tasks = np.split(taskCodes.reshape(-1), np.cumsum(lengths)[:-1])
+    nTasks = len(taskLabels)
+    hasStim = blocks[0][1] is not None
+    if hasStim:
+        stimLabels, stimCodes = np.unique(np.concatenate([b[1] for b in blocks]), return_inverse=True)
+        stims = np.split(stimCodes.reshape(-1), np.cumsum(lengths)[:-1])
+    reps = [transition_counts(t)[0] for t in tasks]
+    isRep = np.zeros(nBlocks - 1, dtype=bool)
+    if nBlocks > 1 and nTasks > 1:
+        isRep = _seam_reps(sum(reps), sum(lengths), nBlocks, _percent_rep(func, args, kwargs), rng)
+        for b in range(1, nBlocks):
+            tasks[b] = _relabel(tasks[b], nTasks, tasks[b - 1][-1], isRep[b - 1], rng)
+    if hasStim:
+        balance = [count_labels(t*len(stimLabels) + s, nTasks*len(stimLabels)) for t, s in zip(tasks, stims)]
+        for b in range(1, nBlocks):
+            if stims[b][0] != stims[b - 1][-1]:
+                continue
+            if _fix_start(tasks[b], stims[b], stims[b - 1][-1], rng):
+                continue
+            # else (short blocks) exchange the repeated stimulus with another
+            # one in the whole block, which keeps its constraints too
+            s0 = stims[b][0]
+            other = (s0 + 1 + int(rng.integers(len(stimLabels) - 1))) % len(stimLabels)
+            swap = np.arange(len(stimLabels))
+            swap[s0], swap[other] = other, s0
+            stims[b] = swap[stims[b]]
+    task = np.concatenate(tasks)
+    # tests: the blocks kept their constraints, the seams are fixed
+    if [transition_counts(t)[0] for t in tasks] != reps:
+        raise Warning("the task repetitions of a block changed")
+    # the whole session has the repetitions the seams were chosen for
+    if nTasks > 1 and transition_counts(task)[0] != sum(reps) + isRep.sum():
+        raise Warning("the task repetitions of the session are not those of the blocks and seams")
+    if hasStim:
+        stim = np.concatenate(stims)
+        # exchanging two stimuli in a block permutes its counts
+        if any((np.sort(count_labels(t*len(stimLabels) + s, nTasks*len(stimLabels))) != np.sort(c)).any() for t, s, c in zip(tasks, stims, balance)):
+            raise Warning("the stimuli of a block are no longer as often with each task")
+        if transition_counts(stim)[0] > sum(transition_counts(s)[0] for s in stims):
+            raise Warning("a stimulus is repeated across blocks")
+    session = pd.DataFrame({"block": np.repeat(np.arange(nBlocks), lengths),
+                            "trial": np.concatenate([np.arange(n) for n in lengths])})
+    columns = [("task", task, taskLabels)] + ([("stim", stim, stimLabels)] if hasStim else [])
+    if encoding is None:
+        for name, codes, labels in columns:
+            session[name] = labels[codes]
+        return session
+    labelsOf = {}
+    for name, codes, labels in columns:
+        encoded = funx_10._encode(codes, labels, encoding)
+        if encoding == "codes":
+            session[name], labelsOf[name] = encoded
+        else:
+            session[name] = encoded
+    if encoding == "codes":
+        return (session, labelsOf)
+    return session
+
+# from funx_10 import orderStimWithinTasks_str
+# if __name__ == "__main__":
+#     session = generate_session(orderStimWithinTasks_str, 8, 96, list(range(8)), ["a", "b"], seed=2020)
+#     print(transition_counts(session["task"].to_numpy()), transition_counts(session["stim"].to_numpy()))
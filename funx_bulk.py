@@ -0,0 +1,109 @@
+"""Generate sequences for many participants in parallel, reproducibly.
+
+Any function of funx_10.py can be run once per participant over a pool of
+processes. Each participant gets an independent seed stream spawned from one
+master seed (np.random.SeedSequence), and the participant's sequence is drawn
+from a np.random.Generator built on that stream (the rng argument of the
+funx_10 functions). The output of a participant therefore only depends on the
+master seed and on the participant's position, never on the number of workers
+or on which worker ran it. Inside a funx_stats.collect_stats block, the
+records of the calls run by the workers are collected as well.
+
+This file can also be imported as a module and contains the following
+functions:
+
+    * participant_seeds
+    * bulk_generate
+"""
+
+import os
+import numpy as np
+import funx_stats
+from concurrent.futures import ProcessPoolExecutor
+
+
+def participant_seeds(seed, n):
+    """independent seed streams, one per participant
+
+    Parameters
+    ----------
+    seed: int or None
+        master seed of the study. None draws a fresh one from the OS: the
+        master seed used is stored in the returned SeedSequences (.entropy)
+    n: int
+        number of participants
+
+    Returns
+    -------
+    list
+        n np.random.SeedSequence, the ith for the ith participant
+    """
+    if type(n) != int or n <= 0:
+        raise ValueError("n must be an integer greater than 0.")
+    return np.random.SeedSequence(seed).spawn(n)
+
+
+def _run_participant(task):
+    """run the function drawing from the participant stream"""
+    func, seedSeq, args, kwargs = task
+    return func(*args, rng=np.random.default_rng(seedSeq), **kwargs)
+
+
+def _run_participant_stats(task):
+    """as _run_participant, also returning the funx_stats records"""
+    with funx_stats.collect_stats() as records:
+        out = _run_participant(task)
+    return out, records
+
+
+def bulk_generate(func, n, *args, seed=None, workers=None, **kwargs):
+    """run a funx_10 function once per participant over a process pool
+
+    Results are bit-identical for the same seed whatever the number of
+    workers, e.g.:
+    seqs = bulk_generate(balanceTransitionsMinus1_str, 500, 96, "magnit", "parity", seed=2020)
+
+    Parameters
+    ----------
+    func: the function to run, must accept a rng argument and be defined at
+        module level (e.g. any function of funx_10) so that it can be sent to
+        the workers
+    n: the number of participants (int)
+    *args, **kwargs: the arguments passed to func at each call
+    seed: int, optional
+        master seed of the study, see participant_seeds
+    workers: int, optional
+        number of processes, defaults to the number of CPUs. With 1 the
+        sequences are generated in the current process
+
+    Returns
+    -------
+    list
+        n outputs of func, the ith for the ith participant
+    """
+    seeds = participant_seeds(seed, n)
+    tasks = [(func, s, args, kwargs) for s in seeds]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        return [_run_participant(t) for t in tasks]
+    # big chunks keep the inter-process overhead low, 4 per worker still
+    # balance the load when some calls need more retries than others
+    chunksize = max(1, n // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        if not funx_stats.active():
+            return list(executor.map(_run_participant, tasks, chunksize=chunksize))
+        # the records of the workers are passed on to the collect_stats
+        # blocks of this process
+        outs = []
+        for out, records in executor.map(_run_participant_stats, tasks, chunksize=chunksize):
+            for record in records:
+                funx_stats._emit(record)
+            outs.append(out)
+        return outs
+
+# from funx_10 import balanceTransitionsMinus1
+# if __name__ == "__main__":
+#     seqs1 = bulk_generate(balanceTransitionsMinus1, 1000, 96, seed=2020, workers=1)
+#     seqs4 = bulk_generate(balanceTransitionsMinus1, 1000, 96, seed=2020, workers=4)
+#     print("identical with 1 and 4 workers? " + str(all((a[0] == b[0]).all() for a, b in zip(seqs1, seqs4))))
@@ -0,0 +1,355 @@
+"""Columnar export of many generated trial tables, readable back memory-mapped.
+
+The sequences of a study (one table per participant, or per participant and
+block) are written as one dataset in long format, one row per trial: the
+metadata columns participant, block, trial and, if known, seed, then one
+column per column of the tables (task, stim, ...). Each of these is stored
+as small integer codes plus a label dictionary, as the _codes functions of
+funx_10.py return them, so 500 participants × 384 trials of tasks and
+stimuli take a few MB instead of a csv per participant.
+
+Formats:
+
+    - "npy": a folder with one .npy file per column and a meta.json with the
+      labels and the metadata; read back memory-mapped
+    - "npz": the same arrays in one uncompressed .npz file (loaded at once:
+      zip members cannot be memory-mapped)
+    - "parquet" and "arrow" (Arrow IPC file, read back memory-mapped):
+      dictionary-encoded columns with the metadata in the schema; they need
+      pyarrow
+
+e.g.
+
+    export_generated("study1", orderStimWithinTasks_str, 500, 384, stimuli, ["a", "b"], seed=2020)
+    codes, labels = read_design("study1", encoding="codes")
+    mine = codes["participant"] == 17
+
+This file can also be imported as a module and contains the following
+functions:
+
+    * export_design
+    * export_generated
+    * read_design
+"""
+
+import os
+import json
+import numpy as np
+import pandas as pd
+from funx_bulk import bulk_generate
+
+FORMATS = ("npy", "npz", "parquet", "arrow")
+# stored as plain integers, without a label dictionary
+META_COLUMNS = ("participant", "block", "trial", "seed")
+# the version of the layout, written in the metadata
+LAYOUT_VERSION = 1
+
+
+def _format(path, format):
+    """the format asked, or the one of the extension of path"""
+    if format is None:
+        ext = os.path.splitext(path)[1].lstrip(".").lower()
+        format = {"npz": "npz", "parquet": "parquet", "arrow": "arrow", "feather": "arrow"}.get(ext, "npy")
+    if format not in FORMATS:
+        raise ValueError("format must be one of " + str(FORMATS) + ".")
+    return format
+
+
+def _pyarrow():
+    """pyarrow, needed only by the parquet and arrow formats"""
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("the parquet and arrow formats need pyarrow (pip install pyarrow); the npy and npz formats need numpy only.")
+    return pyarrow
+
+
+def _code_dtype(nLabels):
+    """the smallest signed int type for the codes (arrow dictionary indices
+    are signed)"""
+    for dtype in (np.int8, np.int16, np.int32):
+        if nLabels <= np.iinfo(dtype).max + 1:
+            return dtype
+    return np.int64
+
+
+def _table(out):
+    """one output of a funx_10 function as a dataframe"""
+    if isinstance(out, (list, tuple)):
+        # e.g. [seq, rep, sw]: the sequence comes first
+        out = out[0]
+    if isinstance(out, pd.DataFrame):
+        return out
+    if isinstance(out, pd.Series):
+        return out.to_frame(out.name if out.name is not None else "seq")
+    return pd.DataFrame({"seq": np.asarray(out)})
+
+
+def _encode_column(values):
+    """codes and labels of the values of one column of all the tables"""
+    values = pd.Series(values) if not isinstance(values, pd.Series) else values
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        labels, codes = values.cat.categories.to_numpy(), values.cat.codes.to_numpy()
+    else:
+        codes, labels = pd.factorize(values, sort=True)
+        labels = np.asarray(labels)
+    if labels.dtype.kind not in "biufU":
+        labels = labels.astype(object)
+    return codes.astype(_code_dtype(len(labels))), labels
+
+
+def _json_labels(labels):
+    """labels as a list for meta.json, with their kind to read them back"""
+    return {"kind": labels.dtype.kind, "values": labels.tolist()}
+
+
+def _labels_from_json(entry):
+    values = entry["values"]
+    if entry["kind"] == "U":
+        return np.array(values, dtype=str)
+    if entry["kind"] in "biuf":
+        return np.array(values)
+    return np.array(values, dtype=object)
+
+
+def export_design(path, tables, participants=None, blocks=None, seeds=None, format=None, meta=None):
+    """write many trial tables as one columnar dataset
+
+    Parameters
+    ----------
+    path: str
+        folder (npy format) or file to write; an existing dataset is replaced
+    tables: list of the outputs of a funx_10 function (dataframes, e.g. of
+        orderStimWithinTasks_str or generate_session, series, sequences or
+        lists [seq, ...]), one per participant (or per participant and
+        block), or one dataframe already in long format
+    participants: list of int, optional
+        the participant of each table, 0, 1, 2... by default (ignored if the
+        tables have a participant column)
+    blocks: list of int, optional
+        the block of each table, 0 by default (ignored if the tables have a
+        block column)
+    seeds: list of int, optional
+        the seed each table was generated with; without it there is no seed
+        column (unless the tables have one)
+    format: str, optional
+        "npy", "npz", "parquet" or "arrow"; by default from the extension of
+        path ("npy" without one)
+    meta: dict, optional
+        further metadata to store, e.g. the generating function; it must be
+        JSON serializable
+
+    Returns
+    -------
+    dict
+        the metadata written: format, rows, columns, labels and meta
+    """
+    format = _format(path, format)
+    if isinstance(tables, pd.DataFrame):
+        tables = [tables]
+    tables = [_table(t) for t in tables]
+    if len(tables) == 0:
+        raise ValueError("there are no tables to export.")
+    for name, given in (("participants", participants), ("blocks", blocks), ("seeds", seeds)):
+        if given is not None and len(given) != len(tables):
+            raise ValueError(name + " must have one element per table.")
+    columns = list(tables[0].columns)
+    if any(list(t.columns) != columns for t in tables):
+        raise ValueError("all the tables must have the same columns.")
+    lengths = np.array([len(t) for t in tables])
+    data = {}
+    # the metadata columns, from the tables or from the arguments
+    defaults = {"participant": participants if participants is not None else np.arange(len(tables)),
+                "block": blocks if blocks is not None else np.zeros(len(tables), dtype=int),
+                "seed": seeds}
+    for name in META_COLUMNS:
+        if name in columns:
+            data[name] = np.concatenate([t[name].to_numpy() for t in tables]).astype(np.int64)
+        elif name == "trial":
+            data[name] = np.concatenate([np.arange(n) for n in lengths])
+        elif defaults[name] is not None:
+            data[name] = np.repeat(np.asarray(defaults[name], dtype=np.int64), lengths)
+    for name in data:
+        if name != "seed":
+            data[name] = data[name].astype(np.int32)
+    labels = {}
+    for c in columns:
+        if c in META_COLUMNS:
+            continue
+        if not isinstance(c, str):
+            raise ValueError("the column names must be strings.")
+        col = [t[c] for t in tables]
+        allCat = all(isinstance(s.dtype, pd.CategoricalDtype) for s in col)
+        data[c], labels[c] = _encode_column(pd.concat(col, ignore_index=True) if allCat else np.concatenate([s.to_numpy() for s in col]))
+    info = {"version": LAYOUT_VERSION, "format": format, "rows": int(lengths.sum()),
+            "columns": list(data), "labels": {c: _json_labels(l) for c, l in labels.items()},
+            "meta": meta if meta is not None else {}}
+    # fails here, before writing, if meta is not JSON serializable
+    infoJson = json.dumps(info)
+    if format == "npy":
+        os.makedirs(path, exist_ok=True)
+        for name in os.listdir(path):
+            if name.endswith(".npy") or name == "meta.json":
+                os.remove(os.path.join(path, name))
+        for name, arr in data.items():
+            np.save(os.path.join(path, name + ".npy"), arr)
+        # written last: a folder without meta.json is not a dataset
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            f.write(infoJson)
+    elif format == "npz":
+        np.savez(path, meta=np.array(infoJson), **{"col_" + name: arr for name, arr in data.items()})
+    else:
+        pa = _pyarrow()
+        fields = {}
+        for name, arr in data.items():
+            if name in labels:
+                fields[name] = pa.DictionaryArray.from_arrays(arr, pa.array(labels[name]))
+            else:
+                fields[name] = pa.array(arr)
+        table = pa.table(fields).replace_schema_metadata({"funx_export": infoJson})
+        if format == "parquet":
+            pa.parquet.write_table(table, path)
+        else:
+            with pa.OSFile(path, "wb") as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+    return info
+
+
+def export_generated(path, func, n, *args, seed=None, workers=None, format=None, **kwargs):
+    """generate the sequences of n participants with bulk_generate and
+    export them with export_design
+
+    Participant p was generated from np.random.SeedSequence(seed).spawn(n)[p]
+    (see bulk_generate): the seed column holds the master seed, which is
+    drawn and stored if not given.
+
+    Parameters
+    ----------
+    path: str
+        see export_design
+    func: the generating function, e.g. orderStimWithinTasks_str
+    n: int
+        number of participants
+    *args, **kwargs: the arguments of func, rng excluded
+    seed: int, optional
+        master seed of the study
+    workers: int, optional
+        number of processes, see bulk_generate
+    format: str, optional
+        see export_design
+
+    Returns
+    -------
+    dict
+        the metadata written, see export_design
+    """
+    if seed is None:
+        # a master seed that fits the int64 seed column
+        seed = int(np.random.SeedSequence().generate_state(1, np.uint64)[0] >> 1)
+    outs = bulk_generate(func, n, *args, seed=seed, workers=workers, **kwargs)
+    meta = {"function": func.__module__ + "." + func.__name__, "args": repr(args),
+            "kwargs": repr(sorted(kwargs.items())), "seed": seed, "participants": n}
+    return export_design(path, outs, seeds=[seed]*n, format=format, meta=meta)
+
+
+def _recode(values, labels):
+    """the codes of values (all found in labels) in labels"""
+    order = np.argsort(labels, kind="stable")
+    return order[np.searchsorted(labels[order], values)]
+
+
+def _read_arrow(path, format):
+    """the code arrays and the metadata of a parquet or arrow file"""
+    pa = _pyarrow()
+    if format == "parquet":
+        table = pa.parquet.read_table(path, memory_map=True)
+    else:
+        table = pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+    info = json.loads(table.schema.metadata[b"funx_export"])
+    data = {}
+    for name in info["columns"]:
+        col = table.column(name)
+        if name not in info["labels"]:
+            data[name] = col.to_numpy()
+        elif pa.types.is_dictionary(col.type) and format == "arrow":
+            # the dictionary written: its indices are the codes
+            col = col.combine_chunks() if col.num_chunks != 1 else col.chunk(0)
+            data[name] = col.indices.to_numpy(zero_copy_only=False)
+        else:
+            # parquet keeps the dictionary encoding of string columns only
+            # (and may rebuild the dictionaries): the values are coded again
+            labels = _labels_from_json(info["labels"][name])
+            codes = _recode(col.cast(col.type.value_type if pa.types.is_dictionary(col.type) else col.type).to_numpy(zero_copy_only=False), labels)
+            data[name] = codes.astype(_code_dtype(len(labels)))
+    return data, info
+
+
+def read_design(path, encoding=None, columns=None, format=None):
+    """read a dataset written by export_design
+
+    Parameters
+    ----------
+    path: str
+        the folder or file written
+    encoding: None, "category" or "codes"
+        None gives the labels (e.g. the task names), "category" pandas
+        Categorical columns, "codes" the code arrays without building a
+        dataframe (memory-mapped for the npy and arrow formats)
+    columns: list of str, optional
+        the columns to read, all by default
+    format: str, optional
+        see export_design; by default "npy" for a folder, else from the
+        extension of path
+
+    Returns
+    -------
+    pd.DataFrame or tuple
+        the dataframe of the trials with the metadata columns, or with
+        encoding="codes" the pair (dict of code arrays by column, dict of
+        labels by column), with labels[c][codes[c]] the values of column c;
+        the metadata is in the attrs of the dataframe ("funx_export")
+    """
+    if encoding not in (None, "category", "codes"):
+        raise ValueError("encoding must be None, 'category' or 'codes'.")
+    if format is None and os.path.isdir(path):
+        format = "npy"
+    format = _format(path, format)
+    if format == "npy":
+        if not os.path.exists(os.path.join(path, "meta.json")):
+            raise ValueError("there is no dataset written by export_design in " + path + ".")
+        with open(os.path.join(path, "meta.json")) as f:
+            info = json.load(f)
+        data = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r") for name in info["columns"]}
+    elif format == "npz":
+        with np.load(path, allow_pickle=False) as npz:
+            info = json.loads(str(npz["meta"]))
+            data = {name: npz["col_" + name] for name in info["columns"]}
+    else:
+        data, info = _read_arrow(path, format)
+    if columns is not None:
+        unknown = [c for c in columns if c not in data]
+        if unknown:
+            raise ValueError("unknown columns " + str(unknown) + ", the dataset has " + str(info["columns"]) + ".")
+        data = {c: data[c] for c in columns}
+    labels = {c: _labels_from_json(info["labels"][c]) for c in data if c in info["labels"]}
+    if encoding == "codes":
+        return data, labels
+    df = pd.DataFrame({c: arr if c not in labels
+                       else (pd.Categorical.from_codes(arr, labels[c]) if encoding == "category" else labels[c][arr])
+                       for c, arr in data.items()})
+    df.attrs["funx_export"] = info
+    return df
+
+# from funx_10 import orderStimWithinTasks_str
+# if __name__ == "__main__":
+#     export_generated("study1", orderStimWithinTasks_str, 500, 384, list(range(24)), ["a", "b"], seed=2020)
+#     codes, labels = read_design("study1", encoding="codes")
+#     print(labels["task"][codes["task"][codes["participant"] == 17]])
+#     # round trip of int labels through parquet (needs pyarrow)
+#     tables = [orderStimWithinTasks_str(96, list(range(24)), ["a", "b"], rng=p) for p in range(10)]
+#     export_design("study1.parquet", tables)
+#     back = read_design("study1.parquet")
+#     print(all((back[back["participant"] == p]["stim"].to_numpy() == t["stim"].to_numpy()).all() for p, t in enumerate(tables)))
@@ -0,0 +1,179 @@
+"""Opt-in statistics on the calls of the pseudorandomizing functions.
+
+Inside a collect_stats block, each call of a funx_10 generator leaves a
+record of what happened in it: how many times it started again from a new
+random sequence (retries), how many swaps its repairs tried and kept, and
+how long it spent shuffling, repairing and checking the sequence, e.g.
+
+    with collect_stats() as records:
+        seq = balanceNMinus2_str(96, "a", "b", "c")
+    print(records[0]["retries"], records[0]["swaps_accepted"])
+
+The functions return exactly what they return without it, and outside a
+collect_stats block recording costs close to nothing. bulk_generate brings
+the records of its worker processes back to the block it is called in, so
+that summarize gives the statistics of a whole bulk run.
+
+This file can also be imported as a module and contains the following
+functions:
+
+    * collect_stats
+    * active
+    * track
+    * current
+    * summarize
+"""
+
+import time
+import threading
+from contextlib import contextmanager
+
+FIELDS = ("retries", "swaps_tried", "swaps_accepted", "shuffle_s", "repair_s", "check_s", "total_s")
+
+_state = threading.local()
+
+
+class _Record(dict):
+    """the record of one call, with helpers to fill it"""
+
+    def add(self, field, n=1):
+        self[field] += n
+
+    @contextmanager
+    def phase(self, name):
+        """time a phase: shuffle, repair or check"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self[name + "_s"] += time.perf_counter() - start
+
+
+class _NoRecord(object):
+    """stands for a record outside collect_stats, does nothing"""
+
+    def add(self, field, n=1):
+        pass
+
+    @contextmanager
+    def phase(self, name):
+        yield
+
+    def __setitem__(self, field, value):
+        pass
+
+
+_noRecord = _NoRecord()
+
+
+def _collectors():
+    if not hasattr(_state, "collectors"):
+        _state.collectors = []
+        _state.stack = []
+    return _state.collectors
+
+
+def active():
+    """whether a collect_stats block is active in this thread"""
+    return bool(_collectors())
+
+
+def _emit(record):
+    for records, callback in _collectors():
+        records.append(record)
+        if callback is not None:
+            callback(record)
+
+
+@contextmanager
+def collect_stats(callback=None):
+    """record the calls made inside the block
+
+    Parameters
+    ----------
+    callback: function, optional
+        called with each record as soon as its call ends
+
+    Yields
+    ------
+    list
+        the records, one dict per call in the order the calls ended: the
+        function name, whether it was called by another function (nested)
+        and the FIELDS
+    """
+    records = []
+    collectors = _collectors()
+    collectors.append((records, callback))
+    try:
+        yield records
+    finally:
+        # by identity: two blocks can hold equal lists
+        for k in range(len(collectors)):
+            if collectors[k][0] is records:
+                del collectors[k]
+                break
+
+
+@contextmanager
+def track(name):
+    """record one call of the function name, used inside the functions
+
+    Yields the record of the call, or a stand-in that ignores everything
+    when no collect_stats block is active.
+    """
+    if not _collectors():
+        yield _noRecord
+        return
+    record = _Record(function=name, nested=bool(_state.stack))
+    record.update(dict.fromkeys(FIELDS, 0))
+    _state.stack.append(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["total_s"] = time.perf_counter() - start
+        _state.stack.pop()
+        _emit(dict(record))
+
+
+def current():
+    """the record of the innermost call being tracked, for helpers such as
+    local_search that count swaps on behalf of their caller"""
+    if not _collectors() or not _state.stack:
+        return _noRecord
+    return _state.stack[-1]
+
+
+def summarize(records, nested=False):
+    """statistics of the records of each function
+
+    Parameters
+    ----------
+    records: list of records from collect_stats
+    nested: bool
+        whether to include the calls made by other functions
+
+    Returns
+    -------
+    dict
+        by function name: number of calls, then total and mean of each of
+        the FIELDS across the calls
+    """
+    summary = {}
+    for r in records:
+        if r["nested"] and not nested:
+            continue
+        s = summary.setdefault(r["function"], dict(calls=0, **{f: 0 for f in FIELDS}))
+        s["calls"] += 1
+        for f in FIELDS:
+            s[f] += r[f]
+    for s in summary.values():
+        for f in FIELDS:
+            s["mean_" + f] = s[f] / s["calls"]
+    return summary
+
+# from funx_10 import balanceNMinus2_str
+# with collect_stats() as records:
+#     for i in range(100):
+#         balanceNMinus2_str(96, "a", "b", "c")
+# print(summarize(records))
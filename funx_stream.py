@@ -0,0 +1,396 @@
+"""Stream very long sequences in chunks of fixed size.
+
+The functions of funx_10.py build the whole sequence before returning it.
+The generators below yield it chunk by chunk instead, e.g.
+
+    for chunk in stream_balanceTransitionsMinus1(10**6, chunk=1000):
+        run_trials(chunk)
+
+The constraints hold on the whole sequence, across the chunk boundaries,
+while memory only depends on the chunk size (and on the number of stimuli)
+and the first chunk comes out after a fixed amount of work whatever the
+length of the sequence:
+
+    * stream_balanceTransitionsMinus1 and stream_exact_repetition_proportion
+      draw the runs of 0s and 1s as funx_10 does, a block of run lengths at
+      a time, so the sequences are equally likely as in funx_10
+    * stream_noStimRepetition draws one element at a time (noStimRepetition)
+    * stream_balanceNMinus2 chains blocks drawn with nminus2_tables.py,
+      relabelled so that the transitions between blocks keep the balance
+    * stream_orderStimWithinTasks gives each task its stimuli in rounds of
+      all the stimuli, so they stay balanced within tasks, avoiding n-1
+      repetitions as it goes
+
+This file can also be imported as a module and contains the following
+functions:
+
+    * stream_balanceTransitionsMinus1
+    * stream_exact_repetition_proportion
+    * stream_noStimRepetition
+    * stream_balanceNMinus2
+    * stream_orderStimWithinTasks
+"""
+
+import math
+import numpy as np
+from funx_10 import _runs_layout, _iter_no_repeat_codes
+from nminus2_tables import sample_nMinus2
+from constraints import no_repeat, local_search
+
+# run lengths drawn at once by _stream_composition
+_BLOCK = 4096
+
+
+def _rechunk(pieces, chunk):
+    """regroup arrays of any length into arrays of chunk elements"""
+    buffer = []
+    size = 0
+    for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
+        if size >= chunk:
+            joined = np.concatenate(buffer)
+            n = size // chunk * chunk
+            for start in range(0, n, chunk):
+                yield joined[start:start+chunk]
+            buffer = [joined[n:]]
+            size -= n
+    if size:
+        yield np.concatenate(buffer)
+
+
+def _stream_composition(total, parts, rng):
+    """lengths of parts runs summing to total, uniformly drawn, in blocks
+
+    Same distribution as funx_10._composition: the parts - 1 cuts among the
+    total - 1 gaps are split between blocks of gaps with hypergeometric
+    draws, then placed uniformly within each block.
+    """
+    if parts == 0:
+        return
+    gapsLeft = total - 1
+    cutsLeft = parts - 1
+    offset = 0
+    last = 0
+    while cutsLeft > 0:
+        size = min(_BLOCK, gapsLeft)
+        k = int(rng.hypergeometric(cutsLeft, gapsLeft - cutsLeft, size))
+        if k:
+            cuts = np.sort(rng.choice(size, k, replace=False)) + offset + 1
+            yield np.diff(np.r_[last, cuts])
+            last = cuts[-1]
+        offset += size
+        gapsLeft -= size
+        cutsLeft -= k
+    yield np.array([total - last])
+
+
+def _stream_runs(n0, n1, nRunsOptions, rng):
+    """funx_10._sample_runs, as pieces of the sequence"""
+    nRuns, first = _runs_layout(n0, n1, nRunsOptions, rng)
+    sizes = (n0, n1) if first == 0 else (n1, n0)
+    # runs of the first element and of the other one, in alternation: the
+    # first element has as many runs as the other or one more
+    firstRuns = _stream_composition(sizes[0], (nRuns+1)//2, rng)
+    otherRuns = _stream_composition(sizes[1], nRuns//2, rng)
+    a = np.zeros(0, dtype=int)
+    b = np.zeros(0, dtype=int)
+    while True:
+        if not a.size:
+            a = next(firstRuns, a)
+        if not b.size:
+            b = next(otherRuns, b)
+        if not a.size:
+            return
+        k = min(a.size, b.size) if b.size else a.size
+        lengths = np.empty(k + min(k, b.size), dtype=int)
+        lengths[0::2] = a[:k]
+        lengths[1::2] = b[:k]
+        values = np.empty(len(lengths), dtype=int)
+        values[0::2] = first
+        values[1::2] = 1 - first
+        yield np.repeat(values, lengths)
+        a = a[k:]
+        b = b[k:]
+
+
+def _check_trials(trials, chunk):
+    if type(trials) != int or type(chunk) != int:
+        raise ValueError("trials and chunk must be of type integer.")
+    if trials <= 0 or chunk <= 0:
+        raise ValueError("trials and chunk must be greater than 0.")
+
+
+def stream_balanceTransitionsMinus1(trials, chunk=1000, rng=None):
+    """balanceTransitionsMinus1, chunk by chunk
+
+    Parameters
+    ----------
+    trials: the lenght of the whole sequence, even (int)
+    chunk: the lenght of each chunk, the last one can be shorter (int)
+    rng: the np.random.Generator to draw from, or an int seed (optional)
+
+    Yields
+    ------
+    np.array
+        the next chunk of 0s and 1s. The whole sequence has as many 0s as
+        1s and n-1 repetitions and switches differing by 1
+    """
+    rng = np.random.default_rng(rng)
+    _check_trials(trials, chunk)
+    if trials%2 != 0:
+        raise ValueError("trials argument must be an even integer.")
+    m = trials//2
+    return _rechunk(_stream_runs(m, m, [m, m + 1], rng), chunk)
+
+
+def stream_exact_repetition_proportion(trials, percent_rep, chunk=1000, rng=None):
+    """exact_repetition_proportion, chunk by chunk, with 0s and 1s
+
+    Parameters
+    ----------
+    trials: the lenght of the whole sequence, even (int)
+    percent_rep: proportion of n-1 repetitions, between 0 and 1 (float)
+    chunk: the lenght of each chunk, the last one can be shorter (int)
+    rng: the np.random.Generator to draw from, or an int seed (optional)
+
+    Yields
+    ------
+    np.array
+        the next chunk of 0s and 1s. The whole sequence has as many 0s as
+        1s and floor(trials*percent_rep) n-1 repetitions (at most trials-2)
+    """
+    rng = np.random.default_rng(rng)
+    _check_trials(trials, chunk)
+    if trials%2 != 0:
+        raise ValueError("trials argument must be an even integer.")
+    if not 0 <= percent_rep <= 1:
+        raise ValueError("percent_rep must be between 0 and 1.")
+    n_rep = min(math.floor(trials*percent_rep), trials-2)
+    return _rechunk(_stream_runs(trials//2, trials//2, [trials - n_rep], rng), chunk)
+
+
+def stream_noStimRepetition(trials, nStim, chunk=1000, rng=None):
+    """noStimRepetition, chunk by chunk, with codes 0..nStim-1
+
+    Parameters
+    ----------
+    trials: the lenght of the whole sequence, a multiple of nStim (int)
+    nStim: number of different elements (int)
+    chunk: the lenght of each chunk, the last one can be shorter (int)
+    rng: the np.random.Generator to draw from, or an int seed (optional)
+
+    Yields
+    ------
+    np.array
+        the next chunk of codes. The whole sequence has each code
+        trials/nStim times and no n-1 repetitions
+    """
+    rng = np.random.default_rng(rng)
+    _check_trials(trials, chunk)
+    if trials%nStim != 0:
+        raise ValueError("nStim must be a divisor of trials, otherwise balancing is not possible by construction.")
+    if nStim < 2:
+        raise ValueError("at least 2 elements are needed to avoid n-1 repetitions.")
+    return _iter_no_repeat_codes([trials//nStim]*nStim, rng, chunk)
+
+
+def _nMinus2_blocks(trials, block, rng):
+    """blocks of sample_nMinus2 chained with balanced boundaries"""
+    sizes = [block]*(trials//block)
+    if trials%block:
+        sizes.append(trials%block)
+    prev = None
+    for size in sizes:
+        seq = sample_nMinus2(size, 1, rng)
+        if prev is not None:
+            # the 2 n-2 transitions across the boundary: one repetition and
+            # one switch, in random order; the first 2 elements of the block
+            # are relabelled to get them
+            u, v = prev
+            r = 3 - u - v
+            x, y = (u, r) if rng.random() < 0.5 else (r, v)
+            labels = np.empty(3, dtype=int)
+            labels[seq[0]], labels[seq[1]] = x, y
+            labels[3 - seq[0] - seq[1]] = 3 - x - y
+            seq = labels[seq]
+        prev = (int(seq[-2]), int(seq[-1]))
+        yield seq
+
+
+def stream_balanceNMinus2(trials, chunk=1000, block=96, rng=None):
+    """balanceNMinus2_str, chunk by chunk, with codes 0, 1 and 2
+
+    Parameters
+    ----------
+    trials: the lenght of the whole sequence, a multiple of 6 (int)
+    chunk: the lenght of each chunk, the last one can be shorter (int)
+    block: int
+        lenght of the blocks drawn with nminus2_tables.sample_nMinus2, a
+        multiple of 6. Its counting table is built once (see count_table)
+    rng: the np.random.Generator to draw from, or an int seed (optional)
+
+    Yields
+    ------
+    np.array
+        the next chunk of codes. The whole sequence has trials/3 of each
+        code, no n-1 repetitions and as many n-2 repetitions as switches
+    """
+    rng = np.random.default_rng(rng)
+    _check_trials(trials, chunk)
+    if trials%6 != 0 or type(block) != int or block <= 0 or block%6 != 0:
+        raise ValueError("trials and block must be multiples of 6.")
+    return _rechunk(_nMinus2_blocks(trials, block, rng), chunk)
+
+
+def _assign_stim_stream(tasks, nTasks, nStim, perTask, rng):
+    """stimuli for a stream of task chunks, as pieces of (task, stim) rows
+
+    Each task takes its stimuli from a pool holding one round of all the
+    stimuli, refilled with the next round when empty or when it only holds
+    the previous stimulus. When the last stimuli of a task can only repeat
+    the previous one, the stimulus is swapped with an earlier one of the
+    same task or, if no such swap exists, the stimuli of the rows held back
+    are rearranged within tasks: the last rows are held back for this, so
+    that no row given out has to change.
+    """
+    hold = 8*nStim + 8
+    rounds = perTask//nStim
+    pool = [[1]*nStim for t in range(nTasks)]
+    left = [nStim]*nTasks
+    roundsLeft = [rounds - 1]*nTasks
+    # rows not given out yet, and the stimulus of the last one given out
+    taskRows = []
+    stimRows = []
+    lastOut = -1
+    prev = -1
+    for taskChunk in tasks:
+        draws = rng.random(len(taskChunk))
+        for i, t in enumerate(np.asarray(taskChunk).tolist()):
+            p = pool[t]
+            avail = left[t] - (p[prev] if prev >= 0 else 0)
+            if avail == 0 and roundsLeft[t] > 0:
+                for s in range(nStim):
+                    p[s] += 1
+                left[t] += nStim
+                roundsLeft[t] -= 1
+                avail = left[t] - p[prev]
+            if avail == 0:
+                # only prev is left for this task: give it to an earlier
+                # position of the task whose neighbours are not prev, or
+                # else rearrange the rows held back
+                s = _swap_back(taskRows, stimRows, lastOut, t, prev)
+                p[prev] -= 1
+                if s is None:
+                    taskRows.append(t)
+                    stimRows.append(prev)
+                    _repair_held(taskRows, stimRows, lastOut, rng)
+                    left[t] -= 1
+                    prev = stimRows[-1]
+                    continue
+            else:
+                u = int(draws[i]*avail)
+                s = 0
+                while True:
+                    if s != prev:
+                        if u < p[s]:
+                            break
+                        u -= p[s]
+                    s += 1
+                p[s] -= 1
+            left[t] -= 1
+            taskRows.append(t)
+            stimRows.append(s)
+            prev = s
+        if len(stimRows) > hold:
+            out = len(stimRows) - hold
+            yield np.c_[taskRows[:out], stimRows[:out]]
+            lastOut = stimRows[out - 1]
+            del taskRows[:out], stimRows[:out]
+    if stimRows:
+        yield np.c_[taskRows, stimRows]
+
+
+def _swap_back(taskRows, stimRows, lastOut, t, prev):
+    """put prev at an earlier row of task t and return its stimulus
+
+    The row is searched backwards among the rows held back; its stimulus s
+    must differ from prev, as must the stimuli around it. Returns s, which
+    goes to the next row.
+    """
+    for j in range(len(stimRows) - 2, -1, -1):
+        s = stimRows[j]
+        if taskRows[j] != t or s == prev:
+            continue
+        before = stimRows[j-1] if j > 0 else lastOut
+        if before != prev and stimRows[j+1] != prev:
+            stimRows[j] = prev
+            return s
+    return None
+
+
+def _repair_held(taskRows, stimRows, lastOut, rng):
+    """remove the n-1 repetitions of the rows held back, in place
+
+    The stimuli are swapped within tasks by local_search, after lastOut (the
+    last stimulus given out), which does not move.
+    """
+    # lastOut is a group of its own, never swapped
+    groups = [-1] + taskRows
+    seq = [lastOut] + stimRows
+    for attempt in range(20):
+        fixed, score, swaps = local_search(seq, [no_repeat(lag=1)], groups=groups, rng=rng)
+        if score == 0:
+            stimRows[:] = fixed[1:].tolist()
+            return
+    raise Warning("the stimuli could not be assigned without n-1 repetitions at the end of the sequence")
+
+
+def stream_orderStimWithinTasks(trials, nStim, chunk=1000, taskStream=None, nTasks=2, rng=None):
+    """orderStimWithinTasks, chunk by chunk, with task and stimulus codes
+
+    Parameters
+    ----------
+    trials: the lenght of the whole sequence (int)
+    nStim: number of different stimuli, a divisor of trials/nTasks, 3 or
+        more (int)
+    chunk: the lenght of each chunk, the last one can be shorter (int)
+    taskStream: iterable, optional
+        chunks of task codes 0..nTasks-1, each code trials/nTasks times in
+        total, e.g. stream_balanceNMinus2(trials) with nTasks = 3. Defaults
+        to stream_balanceTransitionsMinus1(trials, chunk)
+    nTasks: number of tasks in taskStream (int)
+    rng: the np.random.Generator to draw from, or an int seed (optional)
+
+    Yields
+    ------
+    np.array
+        the next chunk, 2 columns: task code and stimulus code. In the
+        whole sequence each stimulus is trials/nTasks/nStim times with each
+        task and never in 2 subsequent rows. The last 8*nStim + 8 rows
+        drawn are held back, to avoid n-1 repetitions at the end
+    """
+    rng = np.random.default_rng(rng)
+    _check_trials(trials, chunk)
+    if (trials/nTasks)%nStim != 0:
+        raise ValueError("nStim must be a divisor of trials/nTasks, otherwise balancing is not possible by construction.")
+    if nStim < 2:
+        raise ValueError("at least 2 stimuli are needed to avoid n-1 repetitions.")
+    if nStim == 2:
+        # the stimuli must alternate, so their balance within tasks depends
+        # on the whole task sequence (see two_stim_feasible), unknown here
+        raise ValueError("with 2 stimuli the balance within tasks depends on the whole task sequence: use orderStimWithinTasks_codes, or 3 stimuli or more.")
+    if taskStream is None:
+        taskStream = stream_balanceTransitionsMinus1(trials, chunk, rng)
+    pieces = _assign_stim_stream(_rechunk(taskStream, chunk), nTasks, nStim, trials//nTasks, rng)
+    return _rechunk(pieces, chunk)
+
+# from transition_stats import transition_counts
+# rep = sw = 0
+# last = None
+# for chunk in stream_balanceTransitionsMinus1(10**6, chunk=1000, rng=2020):
+#     seq = chunk if last is None else np.r_[last, chunk]
+#     r, s = transition_counts(seq)
+#     rep, sw = rep + r, sw + s
+#     last = chunk[-1:]
+# print(rep - sw)
@@ -0,0 +1,181 @@
+"""Exact, uniform sampling of 3-task sequences with balanced n-2 transitions.
+
+balanceNMinus2_str starts from a random sequence and repairs it. Here the
+sequences of 3 tasks with equal counts, no n-1 repetitions and
+|n-2 repetitions - n-2 switches| <= tol are counted by dynamic programming
+instead, and one of them is drawn with every valid sequence equally likely,
+in a single pass and without retries.
+
+Without n-1 repetitions, the task after the pair (a, b) is either a (n-2
+repetition) or the third task c (n-2 switch). Relabelling the tasks by their
+role (a: second-last, b: last, c: the other one), the number of ways to end a
+sequence only depends on the tasks still to place in each role and on how
+many n-2 repetitions are still allowed. The table of these numbers is slow to
+build for long sequences, so it is kept in memory and saved to disk (one .npy
+file per trials and tolerance, see TABLES_DIR): later draws only read
+trials entries of it. Its size grows as trials**4, so tables above
+MAX_TABLE_BYTES (about 204 trials) are not built: longer sequences
+can be drawn with balanceNMinus2_str or stream_balanceNMinus2.
+
+This file can also be imported as a module and contains the following
+functions:
+
+    * count_table
+    * sample_nMinus2
+"""
+
+import os
+import numpy as np
+
+# where the tables are saved, None to keep them in memory only
+TABLES_DIR = os.path.join(os.path.expanduser("~"), ".cache", "funx_tables")
+
+# largest table built, 256 MB: 204 trials with tol=1
+MAX_TABLE_BYTES = 2**28
+
+# tables already built or loaded in this process, by (trials, tasks, tol)
+_tables = {}
+
+
+def _rep_bounds(trials, tol):
+    """smallest and largest number of n-2 repetitions allowed"""
+    transitions = trials - 2
+    return max(0, -((tol - transitions) // 2)), (transitions + tol) // 2
+
+
+def _build_table(m, rmax, width):
+    """count the ways to end a sequence from each state
+
+    table[na, nb, nc, j] is the number of ways to place na, nb and nc more
+    tasks of role a, b and c with at most j n-2 repetitions and at least
+    j - width of them.
+    """
+    table = np.zeros((m + 1, m + 1, m + 1, rmax + 1))
+    table[0, 0, 0, :width + 1] = 1
+    j = np.arange(rmax + 1)
+    grid = np.indices((m + 1, m + 1)).reshape(2, -1)
+    for left in range(1, 3*m + 1):
+        # all the states with left tasks still to place
+        na, nb = grid
+        nc = left - na - nb
+        keep = (nc >= 0) & (nc <= m)
+        na, nb, nc = na[keep], nb[keep], nc[keep]
+        counts = np.zeros((na.size, rmax + 1))
+        # repetition: place a, the new pair is (b, a)
+        ok = na > 0
+        counts[ok, 1:] += table[nb[ok], na[ok] - 1, nc[ok]][:, :-1]
+        # switch: place c, the new pair is (b, c)
+        ok = nc > 0
+        counts[ok] += table[nb[ok], nc[ok] - 1, na[ok]][:, j]
+        table[na, nb, nc] = counts
+    return table
+
+
+def count_table(trials, tol=1, cacheDir=TABLES_DIR):
+    """table of the number of valid endings of 3-task n-2 balanced sequences
+
+    Built once per (trials, 3 tasks, tol), then taken from memory or from
+    cacheDir. It has about (trials/3)**3 * trials/2 entries, e.g. 14 MB for
+    96 trials, 210 MB for 192 trials; a table larger than MAX_TABLE_BYTES
+    raises ValueError instead of being built.
+
+    Parameters
+    ----------
+    trials: the length of the sequences, a multiple of 3 (int)
+    tol: int
+        largest |n-2 repetitions - n-2 switches| allowed
+    cacheDir: str, optional
+        folder of the saved tables, None not to save them
+
+    Returns
+    -------
+    np.array
+        of shape (trials/3 + 1, trials/3 + 1, trials/3 + 1, rmax + 1), see
+        _build_table
+    """
+    if type(trials) != int or type(tol) != int:
+        raise ValueError("trials and tol must be of type integer.")
+    if trials < 3 or trials % 3 != 0:
+        raise ValueError("trials must be a multiple of 3 greater than 0.")
+    if tol < 0:
+        raise ValueError("tol must be 0 or greater.")
+    key = (trials, 3, tol)
+    if key in _tables:
+        return _tables[key]
+    path = None
+    if cacheDir is not None:
+        path = os.path.join(cacheDir, "nMinus2_%d_%d_%d.npy" % key)
+    if path is not None and os.path.exists(path):
+        table = np.load(path, mmap_mode="r")
+    else:
+        rmin, rmax = _rep_bounds(trials, tol)
+        size = (trials // 3 + 1)**3 * (rmax + 1) * 8
+        if size > MAX_TABLE_BYTES:
+            raise ValueError("the table of " + str(trials) + " trials would take " + str(size // 2**20) + " MB, more than MAX_TABLE_BYTES (" + str(MAX_TABLE_BYTES // 2**20) + " MB, 204 trials with tol=1): use balanceNMinus2_str, or stream_balanceNMinus2 with shorter blocks.")
+        table = _build_table(trials // 3, rmax, rmax - rmin)
+        if path is not None:
+            os.makedirs(cacheDir, exist_ok=True)
+            # write to a temporary file first, so that another process never
+            # reads a half-written table
+            tmp = path + ".%d.tmp" % os.getpid()
+            with open(tmp, "wb") as f:
+                np.save(f, table)
+            os.replace(tmp, path)
+    _tables[key] = table
+    return table
+
+
+def sample_nMinus2(trials, tol=1, rng=None, cacheDir=TABLES_DIR):
+    """draw one sequence of 0, 1 and 2 uniformly among the valid ones
+
+    Valid sequences have trials/3 of each task, no n-1 repetitions and
+    |n-2 repetitions - n-2 switches| <= tol.
+
+    Parameters
+    ----------
+    trials: the length of the sequence, a multiple of 3 (int)
+    tol: int
+        largest |n-2 repetitions - n-2 switches| allowed
+    rng: the np.random.Generator to draw from, or an int seed (optional)
+    cacheDir: str, optional
+        folder of the saved tables, see count_table
+
+    Returns
+    -------
+    np.array
+        the sequence of 0, 1 and 2
+    """
+    rng = np.random.default_rng(rng)
+    table = count_table(trials, tol, cacheDir)
+    m = trials // 3
+    j = _rep_bounds(trials, tol)[1]
+    # every first pair of different tasks has the same number of endings
+    a, b, c = rng.permutation(3).tolist()
+    left = {a: m - 1, b: m - 1, c: m}
+    total = table[left[a], left[b], left[c], j]
+    if total == 0:
+        raise ValueError("no sequence of " + str(trials) + " trials has |n-2 repetitions - n-2 switches| <= " + str(tol) + ".")
+    seq = np.empty(trials, dtype=int)
+    seq[0], seq[1] = a, b
+    u = rng.random(trials)
+    for pos in range(2, trials):
+        rep = 0.
+        if left[a] > 0 and j > 0:
+            rep = table[left[b], left[a] - 1, left[c], j - 1]
+        if u[pos] * total < rep:
+            # n-2 repetition
+            seq[pos] = a
+            left[a] -= 1
+            j -= 1
+            total = rep
+            a, b = b, a
+        else:
+            seq[pos] = c
+            left[c] -= 1
+            total = table[left[b], left[c], left[a], j]
+            a, b, c = b, c, a
+    return seq
+
+# from transition_stats import transition_counts
+# seq = sample_nMinus2(96, rng=2020)
+# print(transition_counts(seq, lag=2), transition_counts(seq)[0])
@@ -0,0 +1,289 @@
+"""On-disk bank of pregenerated sequences, drawn without replacement.
+
+Experiments often ask for sequences with the same parameters over and over,
+e.g. balanceTransitionsMinus1(96) or orderStimWithinTasks_str(384, 24
+stimuli, 2 tasks). The bank generates many of them in advance (with
+bulk_generate, so each is checked by the function that made it) and stores
+them as .npy files, one folder per function and parameters. Drawing a
+sequence is then a lookup in a memory-mapped file instead of a generation.
+
+Each sequence is handed out only once. When a bank runs low it is refilled in
+a background thread, and the least recently used banks are deleted when the
+banks take more than maxBytes on disk. Threads of one process can draw from
+the same bank; different processes should use different bankDir.
+
+This file can also be imported as a module and contains the following
+functions:
+
+    * bank_key
+    * fill_bank
+    * draw
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import threading
+import numpy as np
+from funx_bulk import bulk_generate
+
+# where the banks are saved and how much disk space they can take
+BANK_DIR = os.path.join(os.path.expanduser("~"), ".cache", "funx_bank")
+BANK_MAX_BYTES = 2**30
+
+# one lock per bank folder, to keep draws and refills of this process apart
+_locks = {}
+_locksLock = threading.Lock()
+# memory maps already open, by file
+_maps = {}
+# banks being refilled in the background by this process
+_refilling = set()
+
+
+def bank_key(func, *args, **kwargs):
+    """name of the folder of the bank of func called with these arguments
+
+    Parameters
+    ----------
+    func: the generating function, e.g. balanceTransitionsMinus1
+    *args, **kwargs: the arguments of func, rng excluded
+
+    Returns
+    -------
+    str
+        the function name followed by a hash of the arguments
+    """
+    params = repr(args) + repr(sorted(kwargs.items()))
+    digest = hashlib.sha1((func.__module__ + "." + func.__name__ + params).encode()).hexdigest()
+    return func.__name__ + "_" + digest[:16]
+
+
+def _lock(folder):
+    with _locksLock:
+        return _locks.setdefault(folder, threading.Lock())
+
+
+def _pandas():
+    """pandas, imported by the first draw that returns a Series or DataFrame"""
+    import pandas
+    return pandas
+
+
+def _fields(out):
+    """the arrays to store for one output of a function, and its kind"""
+    if isinstance(out, (list, tuple)):
+        # e.g. [seq, rep, sw]: the sequence comes first
+        out = out[0]
+    # a function returning pandas objects has imported pandas already
+    pd = sys.modules.get("pandas")
+    if pd is None:
+        return [np.asarray(out)], "array", None
+    if isinstance(out, pd.DataFrame):
+        return [out[c].to_numpy() for c in out.columns], "frame", [str(c) for c in out.columns]
+    if isinstance(out, pd.Series):
+        return [out.to_numpy()], "series", None
+    return [np.asarray(out)], "array", None
+
+
+def _stack(column):
+    """stack one field of all the outputs, object arrays as unicode"""
+    arr = np.stack(column)
+    if arr.dtype == object:
+        # object arrays cannot be memory-mapped
+        arr = np.array(arr.tolist())
+    return arr
+
+
+def _read_meta(folder):
+    with open(os.path.join(folder, "meta.json")) as f:
+        return json.load(f)
+
+
+def _write_meta(folder, meta):
+    tmp = os.path.join(folder, "meta.json.%d.tmp" % os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp, os.path.join(folder, "meta.json"))
+
+
+def _field_path(folder, k, version):
+    # a refill writes new files instead of replacing the mapped ones, which
+    # Windows would not allow
+    return os.path.join(folder, "field%d_%d.npy" % (k, version))
+
+
+def _load(path):
+    """memory map of path, opened only once"""
+    if path not in _maps:
+        _maps[path] = np.load(path, mmap_mode="r")
+    return _maps[path]
+
+
+def _folder_size(folder):
+    return sum(os.path.getsize(os.path.join(folder, f)) for f in os.listdir(folder))
+
+
+def _evict(bankDir, maxBytes, keep):
+    """delete the least recently used banks until they fit in maxBytes"""
+    banks = []
+    for name in os.listdir(bankDir):
+        folder = os.path.join(bankDir, name)
+        try:
+            lastUsed = _read_meta(folder)["lastUsed"]
+            banks.append((lastUsed, folder, _folder_size(folder)))
+        except (OSError, ValueError, KeyError):
+            continue
+    total = sum(b[2] for b in banks)
+    for lastUsed, folder, size in sorted(banks):
+        if total <= maxBytes:
+            break
+        if os.path.basename(folder) == keep:
+            continue
+        shutil.rmtree(folder, ignore_errors=True)
+        total -= size
+
+
+def fill_bank(func, n, *args, bankDir=BANK_DIR, maxBytes=BANK_MAX_BYTES, seed=None, workers=None, **kwargs):
+    """add n new sequences to the bank of func called with args and kwargs
+
+    The sequences not drawn yet are kept, so this is also how a bank is
+    refilled.
+
+    Parameters
+    ----------
+    func: the generating function, must accept a rng argument (see
+        bulk_generate)
+    n: number of sequences to add (int)
+    *args, **kwargs: the arguments of func
+    bankDir: str, optional
+        folder of the banks
+    maxBytes: int, optional
+        disk space of all the banks, the least recently used ones are
+        deleted above it
+    seed, workers: see bulk_generate
+
+    Returns
+    -------
+    int
+        number of sequences in the bank not drawn yet
+    """
+    key = bank_key(func, *args, **kwargs)
+    folder = os.path.join(bankDir, key)
+    # the slow part, out of the lock so that draws can go on meanwhile
+    outs = bulk_generate(func, n, *args, seed=seed, workers=workers, **kwargs)
+    fields = [_fields(out) for out in outs]
+    kind, columns = fields[0][1], fields[0][2]
+    new = [_stack([f[0][k] for f in fields]) for k in range(len(fields[0][0]))]
+    with _lock(folder):
+        os.makedirs(folder, exist_ok=True)
+        meta = None
+        version = 0
+        if os.path.exists(os.path.join(folder, "meta.json")):
+            meta = _read_meta(folder)
+            version = meta["version"] + 1
+        for k, arr in enumerate(new):
+            if meta is not None:
+                # keep the sequences not drawn yet, before the new ones
+                old = np.asarray(_load(_field_path(folder, k, meta["version"]))[meta["next"]:])
+                if old.dtype.kind == "U" and arr.dtype.kind == "U":
+                    width = max(old.dtype.itemsize, arr.dtype.itemsize) // 4
+                    old, arr = old.astype("U%d" % width), arr.astype("U%d" % width)
+                arr = np.concatenate([old, arr])
+            path = _field_path(folder, k, version)
+            tmp = path + ".%d.tmp" % os.getpid()
+            with open(tmp, "wb") as f:
+                np.save(f, arr)
+            os.replace(tmp, path)
+        left = len(arr)
+        _write_meta(folder, {"func": func.__module__ + "." + func.__name__,
+                             "params": repr(args) + repr(sorted(kwargs.items())),
+                             "kind": kind, "columns": columns,
+                             "fields": len(new), "version": version,
+                             "next": 0, "lastUsed": time.time()})
+        # files of the previous versions; those still mapped by another
+        # process are deleted by a later refill
+        for name in os.listdir(folder):
+            if name.startswith("field") and not name.endswith("_%d.npy" % version):
+                path = os.path.join(folder, name)
+                _maps.pop(path, None)
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+    _evict(bankDir, maxBytes, key)
+    return left
+
+
+def draw(func, *args, bankDir=BANK_DIR, maxBytes=BANK_MAX_BYTES, refillBelow=100, refillSize=1000, **kwargs):
+    """take the next sequence of the bank of func called with args and kwargs
+
+    e.g. seq = draw(balanceTransitionsMinus1, 96)
+    The bank is filled the first time (and whenever it is empty) in the
+    current thread, and refilled in a background thread when fewer than
+    refillBelow sequences are left.
+
+    Parameters
+    ----------
+    func: the generating function, must accept a rng argument
+    *args, **kwargs: the arguments of func
+    bankDir: str, optional
+        folder of the banks
+    maxBytes: int, optional
+        disk space of all the banks, see fill_bank
+    refillBelow: int
+        number of sequences left that starts a background refill
+    refillSize: int
+        number of sequences added by a refill
+
+    Returns
+    -------
+    np.array, pd.Series or pd.DataFrame
+        the sequence as func returns it; for functions returning a list
+        (e.g. [seq, rep, sw]) only the sequence. Arrays are read-only views
+        of the memory-mapped bank, without a copy (np.array(seq) gives a
+        writable copy); series and dataframes are copies
+    """
+    key = bank_key(func, *args, **kwargs)
+    folder = os.path.join(bankDir, key)
+    fill = lambda: fill_bank(func, refillSize, *args, bankDir=bankDir, maxBytes=maxBytes, **kwargs)
+
+    def refill():
+        try:
+            fill()
+        finally:
+            _refilling.discard(folder)
+
+    while True:
+        with _lock(folder):
+            if os.path.exists(os.path.join(folder, "meta.json")):
+                meta = _read_meta(folder)
+                fields = [_load(_field_path(folder, k, meta["version"])) for k in range(meta["fields"])]
+                left = len(fields[0]) - meta["next"]
+                if left > 0:
+                    i = meta["next"]
+                    # read-only views of the memory map: the mapping stays
+                    # valid while they exist, even after the next refill
+                    # deletes the file (where the OS allows it)
+                    values = [f[i] for f in fields]
+                    meta["next"] = i + 1
+                    meta["lastUsed"] = time.time()
+                    _write_meta(folder, meta)
+                    break
+        fill()
+    if left - 1 < refillBelow and folder not in _refilling:
+        _refilling.add(folder)
+        threading.Thread(target=refill, daemon=True).start()
+    # pandas copies the views into the dataframe or series
+    if meta["kind"] == "frame":
+        return _pandas().DataFrame(dict(zip(meta["columns"], values)))
+    if meta["kind"] == "series":
+        return _pandas().Series(values[0])
+    return values[0]
+
+# from funx_10 import balanceTransitionsMinus1
+# if __name__ == "__main__":
+#     fill_bank(balanceTransitionsMinus1, 1000, 96, seed=2020)
+#     seq = draw(balanceTransitionsMinus1, 96)
@@ -0,0 +1,97 @@
+"""Vectorized statistics on sequences of tasks or stimuli.
+
+Shared by the pseudorandomizing functions in funx_10.py to count elements,
+n-1 / n-2 repetitions and switches and runs of identical elements without
+looping over the sequence in Python.
+
+Every function accepts either a single sequence (1-D) or a batch of sequences
+stacked as rows of a 2-D array; statistics are always computed along the last
+axis.
+
+This file can also be imported as a module and contains the following
+functions:
+
+    * count_labels
+    * transition_counts
+    * run_lengths
+"""
+
+import numpy as np
+
+
+def count_labels(seq, n_labels=None):
+    """count how many times each label appears
+
+    Labels must be integer codes 0, 1, ..., n_labels-1 (e.g. the 0s and 1s of
+    balanceTransitionsMinus1).
+
+    Parameters
+    ----------
+    seq: 1-D or 2-D array of int
+    n_labels: int, optional
+        number of possible labels, defaults to max(seq) + 1
+
+    Returns
+    -------
+    np.array
+        of length n_labels (or shape (rows, n_labels) for a 2-D seq) with
+        the number of occurrences of each label
+    """
+    seq = np.asarray(seq)
+    if n_labels is None:
+        n_labels = int(seq.max()) + 1 if seq.size else 0
+    if seq.ndim == 1:
+        return np.bincount(seq, minlength=n_labels)
+    # shift each row into its own block of n_labels bins and count once
+    rows = seq.shape[0]
+    offset = seq + np.arange(rows)[:, None] * n_labels
+    return np.bincount(offset.ravel(), minlength=rows*n_labels).reshape(rows, n_labels)
+
+
+def transition_counts(seq, lag=1):
+    """count n-lag repetitions and switches
+
+    A n-lag repetition is a position i where seq[i] == seq[i-lag], a switch is
+    any other position from lag onward. Works with any comparable elements,
+    not only integers.
+
+    Parameters
+    ----------
+    seq: 1-D or 2-D array
+    lag: int
+        1 for n-1 transitions, 2 for n-2 transitions
+
+    Returns
+    -------
+    tuple
+        number of repetitions; number of switches. Ints for a 1-D seq, arrays
+        with one value per row for a 2-D seq
+    """
+    seq = np.asarray(seq)
+    same = seq[..., lag:] == seq[..., :-lag]
+    rep = same.sum(axis=-1)
+    sw = same.shape[-1] - rep
+    if seq.ndim == 1:
+        return int(rep), int(sw)
+    return rep, sw
+
+
+def run_lengths(seq):
+    """runs of identical elements in subsequent positions
+
+    Parameters
+    ----------
+    seq: 1-D array
+
+    Returns
+    -------
+    tuple
+        np.array with the element of each run; np.array with the length of
+        each run. The lengths sum to len(seq)
+    """
+    seq = np.asarray(seq)
+    if seq.size == 0:
+        return seq[:0], np.zeros(0, dtype=int)
+    starts = np.flatnonzero(np.r_[True, seq[1:] != seq[:-1]])
+    lengths = np.diff(np.r_[starts, seq.size])
+    return seq[starts], lengths